@@ -0,0 +1,110 @@
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+from mdp_generators import gridworld_mdp, random_sparse_mdp
+from dp_instrumentation import SweepRecorder
+from policy_evaluation import policy_eval_pm
+from policy_iteration import policy_improvement_pm
+from value_iteration import value_iteration
+
+"""
+Benchmark of the DP solvers on synthetic MDPs of growing size.
+For every (generator, size, solver) we record wall time, sweeps to convergence (and the
+improvement steps of policy iteration), peak memory (tracemalloc, numpy allocations
+included) and state backups per second, and write everything to a JSON file so runs can
+be compared over time. tracemalloc slows down allocations, so the memory is measured in a
+second run and the timed run is untraced.
+"""
+
+
+def _policy_iteration(mdp, gamma, recorder, improvement_recorder):
+    # the evaluation sweeps and the improvement steps are counted separately
+    eval_fn = lambda policy, env, discount_factor: policy_eval_pm(policy, env, discount_factor, callback=recorder)
+    return policy_improvement_pm(mdp, eval_fn, discount_factor=gamma, callback=improvement_recorder)
+
+
+# name -> function(mdp, gamma, recorder, improvement_recorder). recorder gets the sweeps,
+# improvement_recorder the policy improvement steps (only policy iteration has them).
+SOLVERS = {
+    "policy_eval_pm": lambda mdp, gamma, recorder, improvement_recorder: policy_eval_pm(
+        np.ones([mdp.nS, mdp.nA]) / mdp.nA, mdp, gamma, callback=recorder),
+    "policy_improvement_pm": _policy_iteration,
+    "value_iteration": lambda mdp, gamma, recorder, improvement_recorder: value_iteration(
+        mdp, discount_factor=gamma, callback=recorder),
+}
+
+GENERATORS = {
+    # square grid with (about) n states
+    "gridworld": lambda n, seed: gridworld_mdp((int(np.sqrt(n)), int(np.ceil(n / int(np.sqrt(n)))))),
+    "random_sparse": lambda n, seed: random_sparse_mdp(n, seed=seed),
+}
+
+
+def benchmark(sizes, generators=("gridworld", "random_sparse"), solvers=tuple(SOLVERS),
+              discount_factor=0.95, seed=0, out_path="dp_benchmark.json"):
+    """
+    Runs every solver on every generated MDP and writes the results as JSON.
+
+    Args:
+        sizes: Iterable of (approximate) numbers of states, e.g. [10**2, 10**4, 10**6].
+        generators: Names of GENERATORS to use.
+        solvers: Names of SOLVERS to run.
+        discount_factor: gamma used by all solvers. Must be < 1 for the random MDPs.
+        seed: Seed for the random MDP generator.
+        out_path: JSON file to write, or None to skip writing.
+
+    Returns:
+        A list with one result dictionary per run.
+    """
+    results = []
+    for generator in generators:
+        for n in sizes:
+            mdp = GENERATORS[generator](n, seed)
+            for solver in solvers:
+                # every sweep over all states is one recorded row
+                recorder, improvement_recorder = SweepRecorder(), SweepRecorder()
+                start = time.perf_counter()
+                SOLVERS[solver](mdp, discount_factor, recorder, improvement_recorder)
+                wall_time = time.perf_counter() - start
+
+                tracemalloc.start()
+                SOLVERS[solver](mdp, discount_factor, SweepRecorder(), SweepRecorder())
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                # an improvement step backs up all states too
+                backups = (len(recorder) + len(improvement_recorder)) * mdp.nS
+
+                result = {
+                    "generator": generator,
+                    "nS": mdp.nS,
+                    "nA": mdp.nA,
+                    "transitions": int(mdp.P.nnz),
+                    "solver": solver,
+                    "discount_factor": discount_factor,
+                    "wall_time_s": wall_time,
+                    "sweeps": len(recorder),
+                    "improvement_steps": len(improvement_recorder),
+                    "peak_memory_bytes": peak,
+                    "backups_per_s": backups / wall_time if wall_time > 0 else None,
+                }
+                results.append(result)
+                print("{generator} nS={nS} {solver}: {wall_time_s:.3f}s, {sweeps} sweeps, "
+                      "{improvement_steps} improvement steps".format(**result))
+
+    if out_path is not None:
+        with open(out_path, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    # Default run stays small; pass sizes up to 10**7 for the full scaling curve.
+    results = benchmark([10**2, 10**3, 10**4])
@@ -0,0 +1,162 @@
+import numpy as np
+
+from collections import namedtuple
+
+"""
+Vectorized Blackjack simulator. Plays N hands in lockstep with the same rules as
+gym.envs.denny.blackjack.BlackjackEnv (infinite deck, dealer hits below 17, the player
+automatically draws until 12) using NumPy arrays instead of one env.step() call per card.
+Every round draws one card for each hand that takes one, so hands can be as long as the
+rules allow (up to 21 cards with an infinite deck, e.g. eleven aces followed by twos).
+"""
+
+# 1 = Ace, 2-10 = Number cards, Jack/Queen/King = 10
+DECK = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10])
+
+# Padded trajectories of a batch of hands. observations: [N, T, 3] (score, dealer_score, usable_ace),
+# actions: [N, T], rewards: [N, T], lengths: [N] number of steps of every hand,
+# mask: [N, T] True for the steps that belong to the hand. Padding is zero.
+BatchEpisodes = namedtuple("BatchEpisodes", ["observations", "actions", "rewards", "lengths", "mask"])
+
+
+def _hand_value(total, has_ace):
+    """
+    Score and usable ace flag of hands given the card totals (aces counted as 1).
+    """
+    usable_ace = has_ace & (total + 10 <= 21)
+    return np.where(usable_ace, total + 10, total), usable_ace
+
+
+def _draw_until(rng, total, has_ace, n_cards, threshold):
+    """
+    Keeps drawing cards for every hand whose score is below threshold.
+    Updates total, has_ace and n_cards in place.
+    """
+    while True:
+        score, _ = _hand_value(total, has_ace)
+        draw = score < threshold
+        if not draw.any():
+            return
+        card = rng.choice(DECK, size=np.count_nonzero(draw))
+        total[draw] += card
+        has_ace[draw] |= card == 1
+        n_cards[draw] += 1
+
+
+def _stack_steps(columns, shape, dtype):
+    """
+    [N, T, ...] array of the T per-step columns (there are none when N = 0).
+    """
+    if not columns:
+        return np.zeros(shape, dtype=dtype)
+    return np.stack(columns, axis=1).astype(dtype)
+
+
+def simulate_batch(policy, n, rng=None, natural=False):
+    """
+    Plays n Blackjack hands in lockstep.
+
+    Args:
+        policy: Vectorized policy. Called as policy(score, dealer_score, usable_ace) with
+            arrays of length n and returns an array of actions (0 = stick, 1 = hit).
+        n: Number of hands.
+        rng: np.random.Generator or seed.
+        natural: Pay 1.5 for a winning natural (ace + ten) as BlackjackEnv(natural=True).
+
+    Returns:
+        A BatchEpisodes tuple of padded trajectories.
+    """
+    rng = np.random.default_rng(rng)
+    player_cards = rng.choice(DECK, size=(n, 2))
+    dealer_cards = rng.choice(DECK, size=(n, 2))
+
+    player_total = player_cards[:, 0] + player_cards[:, 1]
+    player_ace = (player_cards == 1).any(axis=1)
+    player_n = np.full(n, 2)
+    # Auto-draw another card if the score is less than 12
+    _draw_until(rng, player_total, player_ace, player_n, 12)
+
+    # The dealer's play does not depend on the player, so settle it for all hands up front
+    dealer_show = dealer_cards[:, 0]
+    dealer_total = dealer_cards[:, 0] + dealer_cards[:, 1]
+    dealer_ace = (dealer_cards == 1).any(axis=1)
+    dealer_n = np.full(n, 2)
+    _draw_until(rng, dealer_total, dealer_ace, dealer_n, 17)
+    dealer_score, _ = _hand_value(dealer_total, dealer_ace)
+    dealer_score[dealer_score > 21] = 0
+
+    # one [n] column per step, stacked at the end; finished hands get zeros
+    observations, actions, rewards = [], [], []
+    lengths = np.zeros(n, dtype=np.int64)
+    done = np.zeros(n, dtype=bool)
+
+    while not done.all():
+        active = ~done
+        score, usable_ace = _hand_value(player_total, player_ace)
+        observations.append(np.where(active[:, None], np.stack([score, dealer_show, usable_ace], axis=1), 0))
+        action = np.asarray(policy(score, dealer_show, usable_ace))
+        actions.append(np.where(active, action, 0))
+        rewards.append(np.zeros(n))
+        lengths += active
+
+        # hit: draw a card, lose on a bust
+        hit = active & (action == 1)
+        card = rng.choice(DECK, size=np.count_nonzero(hit))
+        player_total[hit] += card
+        player_ace[hit] |= card == 1
+        player_n[hit] += 1
+        bust = hit & (_hand_value(player_total, player_ace)[0] > 21)
+        rewards[-1][bust] = -1.0
+
+        # stick: compare with the dealer
+        stick = active & (action == 0)
+        player_score = np.where(stick, score, 0)
+        reward = np.sign(player_score - dealer_score).astype(float)
+        if natural:
+            # as BlackjackEnv, a natural is the final hand: ace + ten and no card hit
+            is_natural = (player_n == 2) & player_ace & (player_total == 11)
+            reward[is_natural & (reward == 1)] = 1.5
+        rewards[-1][stick] = reward[stick]
+
+        done |= bust | stick
+
+    T = len(actions)
+    mask = np.arange(T) < lengths[:, None]
+    return BatchEpisodes(_stack_steps(observations, (n, T, 3), np.int64), _stack_steps(actions, (n, T), np.int64),
+                         _stack_steps(rewards, (n, T), np.float64), lengths, mask)
+
+
+if __name__ == "__main__":
+    from gym.envs.denny.blackjack import BlackjackEnv
+
+    def play_env(policy, num_episodes, seed=0):
+        env = BlackjackEnv(natural=True)
+        env.seed(seed)
+        returns, lengths = np.zeros(num_episodes), np.zeros(num_episodes)
+        for i in range(num_episodes):
+            observation, done = env.reset(), False
+            while not done:
+                score, dealer_score, usable_ace = observation
+                action = int(policy(np.array([score]), np.array([dealer_score]), np.array([usable_ace]))[0])
+                observation, reward, done, _ = env.step(action)
+                returns[i] += reward
+                lengths[i] += 1
+        return returns, lengths
+
+    # sticks from 20, and the second one also hits on every soft 21 (so on a natural too)
+    stick_from_20 = lambda score, dealer_score, usable_ace: (score < 20).astype(int)
+    hit_soft_21 = lambda score, dealer_score, usable_ace: ((score < 20) | ((score == 21) & usable_ace)).astype(int)
+
+    # Test: the batched hands have the returns and lengths of BlackjackEnv(natural=True)
+    # (within 4 standard errors), including how often a natural pays 1.5
+    num_episodes = 20000
+    for policy in (stick_from_20, hit_soft_21):
+        batch = simulate_batch(policy, num_episodes, rng=0, natural=True)
+        batch_returns = batch.rewards.sum(axis=1)
+        env_returns, env_lengths = play_env(policy, num_episodes)
+        for batch_values, env_values in [(batch_returns, env_returns), (batch.lengths, env_lengths),
+                                         (batch_returns == 1.5, env_returns == 1.5)]:
+            standard_error = np.sqrt((np.var(batch_values) + np.var(env_values)) / num_episodes)
+            assert abs(np.mean(batch_values) - np.mean(env_values)) < 4 * standard_error + 1e-12
+        if policy is hit_soft_21:
+            assert not (batch_returns == 1.5).any()
@@ -0,0 +1,82 @@
+import csv
+import numpy as np
+
+"""
+Convergence instrumentation for the DP solvers.
+Solvers take an optional callback that is called once per sweep as
+
+    callback(sweep, max_residual, residual_norm, states_changed, elapsed)
+
+    sweep: 1-based sweep (or improvement step) number.
+    max_residual: largest absolute value change in the sweep (the delta compared to theta).
+    residual_norm: L2 norm of the value change.
+    states_changed: number of states whose value changed by more than theta, or whose
+        greedy action changed for policy improvement steps.
+    elapsed: seconds since the solver started.
+
+The default callback=None costs nothing: the solvers skip computing the extra statistics.
+"""
+
+
+def null_callback(sweep, max_residual, residual_norm, states_changed, elapsed):
+    """
+    Callback that ignores everything.
+    """
+    pass
+
+
+class SweepRecorder():
+    """
+    Callback that keeps every sweep in a growable in-memory numpy array.
+    """
+
+    dtype = np.dtype([("sweep", np.int64), ("max_residual", np.float64), ("residual_norm", np.float64),
+                      ("states_changed", np.int64), ("elapsed", np.float64)])
+
+    def __init__(self, capacity=1024):
+        self._records = np.zeros(capacity, dtype=self.dtype)
+        self._n = 0
+
+    def __call__(self, sweep, max_residual, residual_norm, states_changed, elapsed):
+        if self._n == len(self._records):
+            self._records = np.resize(self._records, 2 * len(self._records))
+        self._records[self._n] = (sweep, max_residual, residual_norm, states_changed, elapsed)
+        self._n += 1
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def history(self):
+        """
+        Structured array with one row per recorded sweep, fields as in dtype.
+        """
+        return self._records[:self._n]
+
+    def clear(self):
+        self._n = 0
+
+
+class CsvSweepLogger():
+    """
+    Callback that appends every sweep as a row to a CSV file. Use as a context manager
+    or call close() when done.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(SweepRecorder.dtype.names)
+
+    def __call__(self, sweep, max_residual, residual_norm, states_changed, elapsed):
+        self._writer.writerow([sweep, repr(float(max_residual)), repr(float(residual_norm)),
+                               states_changed, repr(float(elapsed))])
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
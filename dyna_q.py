@@ -0,0 +1,194 @@
+import heapq
+import matplotlib
+import numpy as np
+
+from gym.envs.denny.windy_gridworld import WindyGridworldEnv
+from gym.envs.denny import plotting
+from exploration import EpsilonGreedySampler
+from training_telemetry import TrainingTelemetry
+from value_tables import QTableView, make_q_table
+
+matplotlib.style.use('ggplot')
+
+"""
+Dyna-Q / Dyna-Q+ (Sutton & Barto 8.2 - 8.4): Q-learning from real steps, plus planning
+updates from a learned model of the environment after every real step.
+The model remembers the last observed outcome of every (state, action) in dense arrays.
+"""
+
+
+class TabularModel():
+    """
+    Deterministic model (s, a) -> (r, s', done) learned from observed transitions, stored in
+    flat [nS * nA] arrays. Also keeps the list of observed (s, a) pairs to sample planning
+    updates from, the real step at which every pair was last tried (for the Dyna-Q+ bonus)
+    and the set of predecessors of every state (for prioritized sweeping).
+
+    Args:
+        nS: Number of states.
+        nA: Number of actions.
+    """
+
+    def __init__(self, nS, nA):
+        self.nA = nA
+        self.next_state = np.full(nS * nA, -1, dtype=np.int64)
+        self.reward = np.zeros(nS * nA)
+        self.done = np.zeros(nS * nA, dtype=bool)
+        self.last_tried = np.zeros(nS * nA, dtype=np.int64)
+        self.observed = np.zeros(64, dtype=np.int64)
+        self.n_observed = 0
+        self.predecessors = [set() for _ in range(nS)]
+
+    def update(self, state, action, reward, next_state, done, step):
+        """
+        Records the outcome of a real step (taken at real step number step).
+        """
+        sa = state * self.nA + action
+        previous = self.next_state[sa]
+        if previous < 0:
+            if self.n_observed == len(self.observed):
+                self.observed = np.resize(self.observed, 2 * self.n_observed)
+            self.observed[self.n_observed] = sa
+            self.n_observed += 1
+        if previous != next_state:
+            # the pair now leads somewhere else: move it to the predecessors of its new next state
+            if previous >= 0:
+                self.predecessors[previous].discard(sa)
+            self.predecessors[next_state].add(sa)
+        self.next_state[sa] = next_state
+        self.reward[sa] = reward
+        self.done[sa] = done
+        self.last_tried[sa] = step
+
+    def sample(self, n, rng=np.random):
+        """
+        n flat (s, a) indices drawn uniformly from the observed pairs.
+        """
+        return self.observed[rng.randint(self.n_observed, size=n)]
+
+    def predecessors_of(self, state):
+        """
+        Flat (s, a) indices the model predicts to lead to state.
+        """
+        return list(self.predecessors[state])
+
+
+def dyna_q(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1, n_planning=10, kappa=0.0,
+           prioritized=False, theta=1e-4, dtype=np.float64, telemetry=None):
+    """
+    Dyna-Q: Q-learning with n_planning simulated updates from the learned model after every
+    real step.
+
+    Args:
+        env: OpenAI environment.
+        num_episodes: Number of episodes to run for.
+        discount_factor: Lambda time discount factor.
+        alpha: TD learning rate.
+        epsilon: Chance the sample a random action. Float betwen 0 and 1.
+        n_planning: Number of planning updates per real step.
+        kappa: Dyna-Q+ exploration bonus: planning rewards get kappa * sqrt(steps since the
+            pair was last tried for real). 0 is plain Dyna-Q.
+        prioritized: Order the planning updates by the size of their TD error with a
+            prioritized sweeping queue instead of sampling observed pairs uniformly.
+        theta: Prioritized sweeping only queues pairs with a TD error above theta.
+        dtype: dtype of the Q table.
+        telemetry: (Optional) training_telemetry.TrainingTelemetry every episode is recorded to.
+            By default a progress line is printed every 10 seconds.
+
+    Returns:
+        A tuple (Q, stats).
+        Q is the optimal action-value function, a dictionary view mapping state -> action values
+        of the dense table Q.table (see value_tables.QTableView).
+        stats is an EpisodeStats object with two numpy arrays for episode_lengths and episode_rewards.
+    """
+    Q = make_q_table(env, dtype)
+    Q_flat = Q.reshape(-1)
+    nS, nA = Q.shape
+    model = TabularModel(nS, nA)
+
+    stats = plotting.EpisodeStats(
+        episode_lengths=np.zeros(num_episodes),
+        episode_rewards=np.zeros(num_episodes))
+
+    policy = EpsilonGreedySampler(epsilon, env.action_space.n)
+    # prioritized sweeping queue of (-priority, flat (s, a)); entries may be outdated, an
+    # update with a stale priority is just a little less useful
+    queue = []
+    step = 0
+
+    # Progress and metrics, written out in batches (see training_telemetry)
+    own_telemetry = telemetry is None
+    if own_telemetry:
+        telemetry = TrainingTelemetry(print_progress=True, total_episodes=num_episodes)
+
+    def td_error(sa):
+        bonus = kappa * np.sqrt(step - model.last_tried[sa]) if kappa else 0.0
+        bootstrap = 0.0 if model.done[sa] else discount_factor * Q[model.next_state[sa]].max()
+        return model.reward[sa] + bonus + bootstrap - Q_flat[sa]
+
+    for i_episode in range(num_episodes):
+        state = env.reset()
+        while True:
+            action = policy.sample(Q[state])
+            next_state, reward, done, prob = env.step(action)
+            step += 1
+
+            # direct RL: one Q-learning update from the real step
+            target = reward + (0.0 if done else discount_factor * Q[next_state].max())
+            delta = target - Q[state, action]
+            Q[state, action] += alpha * delta
+            model.update(state, action, reward, next_state, done, step)
+
+            # planning
+            if prioritized:
+                if abs(delta) > theta:
+                    heapq.heappush(queue, (-abs(delta), state * nA + action))
+                for _ in range(n_planning):
+                    if not queue:
+                        break
+                    _, sa = heapq.heappop(queue)
+                    Q_flat[sa] += alpha * td_error(sa)
+                    for pred in model.predecessors_of(sa // nA):
+                        priority = abs(td_error(pred))
+                        if priority > theta:
+                            heapq.heappush(queue, (-priority, pred))
+            elif n_planning:
+                # all sampled updates at once from the current Q; pairs drawn more than once
+                # share the update (as in sarsa_vectorized)
+                sa = model.sample(n_planning)
+                bonus = kappa * np.sqrt(step - model.last_tried[sa]) if kappa else 0.0
+                bootstrap = np.where(model.done[sa], 0.0, discount_factor * Q[model.next_state[sa]].max(axis=1))
+                td_errors = model.reward[sa] + bonus + bootstrap - Q_flat[sa]
+                _, duplicates, counts = np.unique(sa, return_inverse=True, return_counts=True)
+                np.add.at(Q_flat, sa, alpha * td_errors / counts[duplicates])
+
+            state = next_state
+            stats.episode_lengths[i_episode] += 1
+            stats.episode_rewards[i_episode] += reward
+
+            if done == True:
+                break
+
+        telemetry.record(i_episode, stats.episode_lengths[i_episode], stats.episode_rewards[i_episode])
+
+    if own_telemetry:
+        telemetry.close()
+    else:
+        telemetry.flush()
+
+    return QTableView(Q), stats
+
+
+if __name__ == "__main__":
+    # Test: a pair whose next state keeps changing is a predecessor of its latest next state only
+    model = TabularModel(5, 2)
+    for step, next_state in enumerate([1, 2, 1, 3, 3, 4]):
+        model.update(0, 1, 0.0, next_state, False, step)
+    assert [model.predecessors_of(s) for s in range(5)] == [[], [], [], [], [1]]
+
+    env = WindyGridworldEnv()
+    Q, stats = dyna_q(env, 100, n_planning=10)
+    # Q, stats = dyna_q(env, 100, n_planning=10, prioritized=True)
+    print(Q)
+
+    plotting.plot_episode_stats(stats)
@@ -0,0 +1,226 @@
+import os
+import numpy as np
+
+"""
+Columnar storage for trajectories. Steps live in one preallocated structured numpy array
+(observation, action, reward, done) that doubles in size when full, and episodes are
+contiguous slices of it, so reading an episode is a zero-copy view.
+Completed episodes can optionally be spilled to a raw binary file and are then read
+back through np.memmap, which keeps the memory use flat for long runs.
+"""
+
+
+class EpisodeBuffer():
+    """
+    Growable buffer of episodes.
+
+    Args:
+        obs_shape: Shape of a single observation, e.g. (3,) for Blackjack, () for discrete envs.
+        obs_dtype: dtype of the observations.
+        capacity: Initial number of steps kept in memory.
+        spill_path: (Optional) file to move completed episodes to.
+        spill_every: With spill_path, spill once this many steps are held in memory.
+    """
+
+    def __init__(self, obs_shape=(), obs_dtype=np.int64, capacity=4096, spill_path=None, spill_every=1000000):
+        self.dtype = np.dtype([("observation", obs_dtype, obs_shape), ("action", np.int64),
+                               ("reward", np.float64), ("done", np.bool_)])
+        self.spill_path = spill_path
+        self.spill_every = spill_every
+
+        self._steps = np.zeros(capacity, dtype=self.dtype)
+        self._n_steps = 0
+        # _ends[i] is the end (exclusive) of episode i, counted over disk and memory steps
+        self._ends = np.zeros(64, dtype=np.int64)
+        self._n_episodes = 0
+        # steps and episodes that were spilled to disk
+        self._disk_steps = 0
+        self._disk_episodes = 0
+        self._disk = None
+
+        if spill_path is not None and os.path.exists(spill_path):
+            os.remove(spill_path)
+
+    def add(self, observation, action, reward, done):
+        """
+        Appends one step to the current episode. The episode is closed when done is True.
+        """
+        if self._n_steps == len(self._steps):
+            self._steps = np.resize(self._steps, 2 * len(self._steps))
+        self._steps[self._n_steps] = (observation, action, reward, done)
+        self._n_steps += 1
+        if done:
+            self.end_episode()
+
+    def end_episode(self):
+        """
+        Closes the current episode (e.g. when it was truncated rather than done).
+        """
+        end = self._disk_steps + self._n_steps
+        if end == self._episode_start(self._n_episodes):
+            return
+        if self._n_episodes == len(self._ends):
+            self._ends = np.resize(self._ends, 2 * len(self._ends))
+        self._ends[self._n_episodes] = end
+        self._n_episodes += 1
+        if self.spill_path is not None and self._n_steps >= self.spill_every:
+            self.spill()
+
+    def spill(self):
+        """
+        Appends all completed in-memory episodes to spill_path and frees their memory.
+        """
+        completed = self._ends[self._n_episodes - 1] - self._disk_steps if self._n_episodes else 0
+        if completed == 0:
+            return
+        with open(self.spill_path, "ab") as f:
+            self._steps[:completed].tofile(f)
+        # keep the unfinished episode, if any, at the front of the memory buffer
+        remaining = self._n_steps - completed
+        self._steps[:remaining] = self._steps[completed:self._n_steps]
+        self._n_steps = remaining
+        self._disk_steps += completed
+        self._disk_episodes = self._n_episodes
+        self._disk = None
+
+    def clear(self):
+        """
+        Drops all episodes, including the spilled ones.
+        """
+        self._n_steps = 0
+        self._n_episodes = 0
+        self._disk_steps = 0
+        self._disk_episodes = 0
+        self._disk = None
+        if self.spill_path is not None and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    def __len__(self):
+        """
+        Number of completed episodes.
+        """
+        return self._n_episodes
+
+    @property
+    def num_steps(self):
+        """
+        Number of steps of the completed episodes.
+        """
+        return int(self._ends[self._n_episodes - 1]) if self._n_episodes else 0
+
+    def lengths(self, start=0, stop=None):
+        """
+        Lengths of the completed episodes start .. stop-1.
+        """
+        stop = self._n_episodes if stop is None else stop
+        ends = self._ends[start:stop]
+        return np.diff(ends, prepend=self._episode_start(start))
+
+    def _episode_start(self, i):
+        return int(self._ends[i - 1]) if i > 0 else 0
+
+    def _disk_view(self):
+        if self._disk is None:
+            self._disk = np.memmap(self.spill_path, dtype=self.dtype, mode="r", shape=(self._disk_steps,))
+        return self._disk
+
+    def _view(self, lo, hi):
+        """
+        Steps lo .. hi-1 (global step indices). A view unless the range spans disk and memory.
+        """
+        if lo >= self._disk_steps:
+            return self._steps[lo - self._disk_steps:hi - self._disk_steps]
+        if hi <= self._disk_steps:
+            return self._disk_view()[lo:hi]
+        return np.concatenate([self._disk_view()[lo:], self._steps[:hi - self._disk_steps]])
+
+    def episodes(self, start=0, stop=None):
+        """
+        All steps of the completed episodes start .. stop-1 as one structured array,
+        see lengths() for the episode boundaries.
+        """
+        stop = self._n_episodes if stop is None else stop
+        if stop <= start:
+            return self._steps[:0]
+        return self._view(self._episode_start(start), int(self._ends[stop - 1]))
+
+    def episode(self, i):
+        """
+        Structured array view of the steps of episode i (negative indices count from the end).
+        """
+        if i < 0:
+            i += self._n_episodes
+        if not 0 <= i < self._n_episodes:
+            raise IndexError("episode index out of range")
+        return self._view(self._episode_start(i), int(self._ends[i]))
+
+    def __getitem__(self, i):
+        return self.episode(i)
+
+    def __iter__(self):
+        return (self.episode(i) for i in range(self._n_episodes))
+
+    def save(self, path):
+        """
+        Writes the completed episodes to path + ".steps.npy" and path + ".ends.npy".
+        """
+        np.save(path + ".steps.npy", self.episodes())
+        np.save(path + ".ends.npy", self._ends[:self._n_episodes])
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Opens episodes written by save(). With mmap_mode the steps are memory-mapped, not read.
+        """
+        steps = np.load(path + ".steps.npy", mmap_mode=mmap_mode)
+        ends = np.load(path + ".ends.npy")
+        buffer = cls(obs_shape=steps.dtype["observation"].shape, obs_dtype=steps.dtype["observation"].base,
+                     capacity=1)
+        buffer._steps = steps
+        buffer._n_steps = len(steps)
+        buffer._ends = np.array(ends, dtype=np.int64)
+        buffer._n_episodes = len(ends)
+        return buffer
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    # random episodes of 1 .. 20 steps with Blackjack like observations
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 21, size=200)
+    steps = [(rng.integers(0, 32, size=3), rng.integers(2), rng.normal(), t == n - 1)
+             for n in lengths for t in range(n)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        spill_path = os.path.join(tmp, "episodes.bin")
+        in_memory = EpisodeBuffer(obs_shape=(3,), capacity=8)
+        spilling = EpisodeBuffer(obs_shape=(3,), capacity=8, spill_path=spill_path, spill_every=50)
+        for step in steps:
+            in_memory.add(*step)
+            spilling.add(*step)
+
+        # Test: spilled episodes read back from disk exactly as the ones kept in memory,
+        # one by one, as a range across the disk / memory boundary and all at once
+        assert spilling._disk_steps > 0 and spilling._n_steps > 0
+        assert len(spilling) == len(in_memory) == len(lengths)
+        np.testing.assert_array_equal(spilling.lengths(), lengths)
+        for i in range(len(lengths)):
+            np.testing.assert_array_equal(spilling[i], in_memory[i])
+        boundary = int(np.searchsorted(spilling._ends[:len(spilling)], spilling._disk_steps))
+        lo, hi = max(boundary - 3, 0), min(boundary + 3, len(lengths))
+        np.testing.assert_array_equal(spilling.episodes(lo, hi), in_memory.episodes(lo, hi))
+        np.testing.assert_array_equal(spilling.episodes(), in_memory.episodes())
+        np.testing.assert_array_equal(spilling.episodes()["reward"], [step[2] for step in steps])
+
+        # Test: save / load round trip (memory-mapped)
+        spilling.save(os.path.join(tmp, "saved"))
+        loaded = EpisodeBuffer.load(os.path.join(tmp, "saved"))
+        np.testing.assert_array_equal(loaded.lengths(), lengths)
+        np.testing.assert_array_equal(loaded.episodes(), in_memory.episodes())
+        np.testing.assert_array_equal(loaded[-1], in_memory[-1])
+
+        # Test: clear drops the spilled episodes and their file
+        spilling.clear()
+        assert len(spilling) == 0 and not os.path.exists(spill_path)
+        del loaded
@@ -1,11 +1,20 @@
 import numpy as np
 
+from returns import discounted_returns, lambda_returns, n_step_returns
+
 # implement returns calculation G_t for episode below: discount = 1.0
 # practice traversing lists
 
 def calculate_return(episodes, discount=1.0):
-    #implement
-    discounted_return = 0.0
+    """
+    First-visit returns: G_t from the first occurrence of every state to the end of the episode,
+    in the order the states are first visited.
+    """
+    returns = discounted_returns([x[2] for x in episodes], discount)
+    first_occurence = {}
+    for t, x in enumerate(episodes):
+        first_occurence.setdefault(x[0], t)
+    discounted_return = returns[list(first_occurence.values())]
 
     return discounted_return
 
@@ -13,5 +22,23 @@ def calculate_return(episodes, discount=1.0):
 episodes = [[(12, 4, False), 1, 0, (19, 4, False)], [(19, 4, False), 1, -1, (27, 4, False)], [(12, 4, False), 1, 0, (19, 4, False)], [(8, 6, False), 1, -1, (27, 4, False)] ]
 calc_return = calculate_return(episodes)
 
-expected_return = np.array([-2.0, -1.0, -2.0])
+# rewards are r_0..r_3 = 0, -1, 0, -1 and G_t = r_t + discount * G_t+1. The states are first
+# visited at t=0 (12, 4), t=1 (19, 4) and t=3 (8, 6), in that order:
+#   G_0 = 0 + -1 + 0 + -1 = -2,  G_1 = -1 + 0 + -1 = -2,  G_3 = -1
+# The exercise used to expect [-2, -1, -2]: the same three returns in another order.
+expected_return = np.array([0.0 - 1.0 + 0.0 - 1.0, -1.0 + 0.0 - 1.0, -1.0])
 np.testing.assert_array_almost_equal(calc_return, expected_return, decimal=2)
+
+# n-step and lambda-returns give the Monte Carlo return for n >= T and lambda = 1, whatever V is
+rewards = [x[2] for x in episodes]
+first_visits = [0, 1, 3]
+values = np.array([0.5, -0.3, 0.5, 0.2])
+np.testing.assert_array_almost_equal(n_step_returns(rewards, values, n=4)[first_visits], expected_return, decimal=2)
+np.testing.assert_array_almost_equal(lambda_returns(rewards, values, lam=1.0)[first_visits], expected_return, decimal=2)
+
+# 1-step return and lambda = 0 are the TD target r_t + V(S_t+1)
+np.testing.assert_array_almost_equal(n_step_returns(rewards, values, n=1), [0.0 - 0.3, -1.0 + 0.5, 0.0 + 0.2, -1.0])
+np.testing.assert_array_almost_equal(lambda_returns(rewards, values, lam=0.0), n_step_returns(rewards, values, n=1))
+
+# with discount = 0.9: G_0 = 0 + 0.9 * -1 + 0.81 * 0 + 0.729 * -1
+np.testing.assert_array_almost_equal(calculate_return(episodes, 0.9), [-1.629, -1.81, -1.0])
@@ -0,0 +1,105 @@
+import numpy as np
+
+"""
+Epsilon-greedy action selection without a probability vector per step.
+Uniform random numbers are drawn in large batches; one number u decides explore vs exploit
+(u < epsilon) and is then reused: given u < epsilon, u / epsilon is again uniform and picks
+the random action, otherwise (u - epsilon) / (1 - epsilon) breaks ties between greedy actions.
+"""
+
+
+class EpsilonGreedySampler():
+    """
+    Samples actions epsilon-greedily from action values.
+
+    Args:
+        epsilon: The probability to select a random action. Float between 0 and 1, can be
+            changed between calls (e.g. for a decaying epsilon).
+        nA: Number of actions.
+        buffer_size: Number of uniform random numbers drawn at once.
+        rng: (Optional) np.random.Generator or RandomState. Defaults to the global np.random,
+            so np.random.seed still makes runs reproducible.
+    """
+
+    def __init__(self, epsilon, nA, buffer_size=65536, rng=None):
+        self.epsilon = epsilon
+        self.nA = nA
+        self.buffer_size = buffer_size
+        if rng is None:
+            self._random = np.random.random_sample
+        elif isinstance(rng, np.random.Generator):
+            self._random = rng.random
+        else:
+            self._random = rng.random_sample
+        self._uniforms = []
+        self._pos = 0
+        # scratch arrays for the tie breaking
+        self._ties = np.zeros(nA, dtype=bool)
+        self._ties_cumsum = np.zeros(nA, dtype=np.int64)
+
+    def _uniform(self):
+        if self._pos == len(self._uniforms):
+            # a list of floats is quicker to index one by one than the array
+            self._uniforms = self._random(self.buffer_size).tolist()
+            self._pos = 0
+        u = self._uniforms[self._pos]
+        self._pos += 1
+        return u
+
+    def sample(self, q_values):
+        """
+        Picks an action for the action values of the current state: uniformly at random with
+        probability epsilon, else a greedy action (ties broken uniformly at random).
+
+        Args:
+            q_values: Array of the nA action values, e.g. Q[state] or estimator.predict(state).
+
+        Returns:
+            The action (int).
+        """
+        u = self._uniform()
+        if u < self.epsilon:
+            return min(int(u / self.epsilon * self.nA), self.nA - 1)
+
+        best = np.argmax(q_values)
+        np.equal(q_values, q_values[best], out=self._ties)
+        n_ties = np.count_nonzero(self._ties)
+        if n_ties == 1:
+            return int(best)
+        # the k-th of the tied actions
+        k = min(int((u - self.epsilon) / (1.0 - self.epsilon) * n_ties), n_ties - 1)
+        np.cumsum(self._ties, out=self._ties_cumsum)
+        return int(np.searchsorted(self._ties_cumsum, k + 1))
+
+    def sample_batch(self, q_values):
+        """
+        Vectorized sample() for a batch of states, e.g. from N environments stepped together.
+
+        Args:
+            q_values: [N, nA] array of action values, e.g. Q[states].
+
+        Returns:
+            An int array of N actions.
+        """
+        q_values = np.asarray(q_values)
+        u = self._random(len(q_values))
+        explore = u < self.epsilon
+        # rescale u to a fresh uniform on both sides of epsilon, as in sample()
+        u[explore] /= self.epsilon
+        u[~explore] = (u[~explore] - self.epsilon) / (1.0 - self.epsilon)
+        random_actions = np.minimum((u * self.nA).astype(np.int64), self.nA - 1)
+
+        # k-th of the tied greedy actions of every row
+        ties = q_values == q_values.max(axis=1, keepdims=True)
+        n_ties = ties.sum(axis=1)
+        k = np.minimum((u * n_ties).astype(np.int64), n_ties - 1)
+        greedy_actions = np.argmax(np.cumsum(ties, axis=1) > k[:, None], axis=1)
+        return np.where(explore, random_actions, greedy_actions)
+
+    def probabilities(self, q_values):
+        """
+        The action probabilities sample() draws from, like the policy_fn of
+        make_epsilon_greedy_policy (allocates; for inspection, not for the inner loop).
+        """
+        ties = np.asarray(q_values) == np.max(q_values)
+        return np.full(self.nA, self.epsilon / self.nA) + (1.0 - self.epsilon) * ties / ties.sum()
@@ -10,6 +10,8 @@ if "../" not in sys.path:
   sys.path.append("../")
 
 from gym.envs.denny import plotting
+from exploration import EpsilonGreedySampler
+from training_telemetry import TrainingTelemetry
 from sklearn.linear_model import SGDRegressor
 from sklearn.kernel_approximation import RBFSampler
 
@@ -100,7 +102,8 @@ def make_epsilon_greedy_policy(estimator, epsilon, nA):
     return policy_fn
 
 
-def q_learning(env, estimator, num_episodes, discount_factor=1.0, epsilon=0.1, epsilon_decay=1.0):
+def q_learning(env, estimator, num_episodes, discount_factor=1.0, epsilon=0.1, epsilon_decay=1.0, callback=None,
+               telemetry=None):
     """
     Q-Learning algorithm for fff-policy TD control using Function Approximation.
     Finds the optimal greedy policy while following an epsilon-greedy policy.
@@ -112,6 +115,10 @@ def q_learning(env, estimator, num_episodes, discount_factor=1.0, epsilon=0.1, e
         discount_factor: Lambda time discount factor.
         epsilon: Chance the sample a random action. Float betwen 0 and 1.
         epsilon_decay: Each episode, epsilon is decayed by this factor
+        callback: (Optional) called as callback(i_episode, stats) after every episode.
+            Training stops early if it returns True (the remaining stats stay 0).
+        telemetry: (Optional) training_telemetry.TrainingTelemetry every episode is recorded to.
+            By default a progress line with the recent rewards is printed every 10 seconds.
 
     Returns:
         An EpisodeStats object with two numpy arrays for episode_lengths and episode_rewards.
@@ -122,33 +129,32 @@ def q_learning(env, estimator, num_episodes, discount_factor=1.0, epsilon=0.1, e
         episode_lengths=np.zeros(num_episodes),
         episode_rewards=np.zeros(num_episodes))
 
-    for i_episode in range(num_episodes):
-        # The policy we're following
-        policy = make_epsilon_greedy_policy(
-            estimator, epsilon * epsilon_decay ** i_episode, env.action_space.n)
+    # The policy we're following: samples epsilon-greedy actions from the predicted q values
+    policy = EpsilonGreedySampler(epsilon, env.action_space.n)
+
+    # Progress and metrics, written out in batches (see training_telemetry)
+    own_telemetry = telemetry is None
+    if own_telemetry:
+        telemetry = TrainingTelemetry(print_progress=True, total_episodes=num_episodes)
 
-        # Print out which episode we're on, useful for debugging.
-        # Also print reward for last episode
-        last_reward = stats.episode_rewards[i_episode - 1]
-        print("\rEpisode {}/{} ({})".format(i_episode + 1, num_episodes, last_reward), end="")
-        sys.stdout.flush()
+    for i_episode in range(num_episodes):
+        policy.epsilon = epsilon * epsilon_decay ** i_episode
 
         #Init state: state contains [position, velocity]
         state = env.reset()
-        # get the policy for this state using the latest Q values and epsilon.
-        action_prob = policy(state)
-        # now choose an action using the policy distribution vs uniform distribution
-        action = np.random.choice(len(action_prob), p=action_prob) # choice applies the distribution passed in
+        # choose an action for this state using the latest Q values and epsilon.
+        action = policy.sample(estimator.predict(state))
 
         while True:
             # For each step: prepare the input (features X(s,a) and output (target reward)
             # Take the action chosen
-            next_state, reward, done = env.step(action)
+            next_state, reward, done, _ = env.step(action)
 
             # Prepare the target:
-            next_action_prob = policy(next_state) #note policy() calls estimator.predict(state)
-            next_action = np.random.choice(len(next_action_prob), p=next_action_prob)
-            q_next_state = estimator.predict(next_state, next_action)
+            # one prediction for all actions serves both the action choice and the target
+            q_next = estimator.predict(next_state)
+            next_action = policy.sample(q_next)
+            q_next_state = q_next[next_action]
             target = reward + discount_factor*(q_next_state)
 
             # Update the parameters of this model:
@@ -157,11 +163,22 @@ def q_learning(env, estimator, num_episodes, discount_factor=1.0, epsilon=0.1, e
             # set vars for next run:
             action = next_action
             state = next_state
+            stats.episode_lengths[i_episode] += 1
+            stats.episode_rewards[i_episode] += reward
 
             # end if env returns done = True
             if done == True:
                 break
 
+        telemetry.record(i_episode, stats.episode_lengths[i_episode], stats.episode_rewards[i_episode])
+        if callback is not None and callback(i_episode, stats):
+            break
+
+    if own_telemetry:
+        telemetry.close()
+    else:
+        telemetry.flush()
+
     return stats
 
 
@@ -183,12 +200,14 @@ featurizer = sklearn.pipeline.FeatureUnion([
         ])
 featurizer.fit(scaler.transform(observation_examples))
 
-estimator = Estimator()
-# Note: For the Mountain Car we don't actually need an epsilon > 0.0
-# because our initial estimate for all states is too "optimistic" which leads
-# to the exploration of all states.
-stats = q_learning(env, estimator, 100, epsilon=0.0)
+# The demo only runs as a script: the process pool of sweep.py imports this module in its workers.
+if __name__ == "__main__":
+    estimator = Estimator()
+    # Note: For the Mountain Car we don't actually need an epsilon > 0.0
+    # because our initial estimate for all states is too "optimistic" which leads
+    # to the exploration of all states.
+    stats = q_learning(env, estimator, 100, epsilon=0.0)
 
-plotting.plot_cost_to_go_mountain_car(env, estimator)
-plotting.plot_episode_stats(stats, smoothing_window=25)
+    plotting.plot_cost_to_go_mountain_car(env, estimator)
+    plotting.plot_episode_stats(stats, smoothing_window=25)
 
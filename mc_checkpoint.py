@@ -0,0 +1,103 @@
+import os
+import numpy as np
+
+from collections import namedtuple
+
+"""
+Checkpoints for long Monte Carlo prediction runs (see mc_prediction.mc_prediction).
+A checkpoint is a single .npz file with the dense returns_sum / returns_count tables,
+the episode counter, the RNG states of the env and of np.random, and the V snapshots
+taken so far. Files are written to a temporary name and renamed, so a run killed while
+writing never leaves a broken checkpoint behind.
+"""
+
+# returns_sum, returns_count: dense tables. episode: number of episodes done. num_episodes: total of the run.
+# snapshots: {episode count: [2, S] array of dense V and returns_count}.
+# env_rng_state / global_rng_state: RandomState.get_state() tuples or None.
+Checkpoint = namedtuple("Checkpoint", ["returns_sum", "returns_count", "episode", "num_episodes", "discount_factor",
+                                       "snapshots", "env_rng_state", "global_rng_state"])
+
+
+def _pack_rng_state(prefix, state, arrays):
+    # RandomState.get_state(): ('MT19937', keys, pos, has_gauss, cached_gaussian)
+    if state is None:
+        return
+    arrays[prefix + "_keys"] = state[1]
+    arrays[prefix + "_rest"] = np.array([state[2], state[3], state[4]], dtype=np.float64)
+
+
+def _unpack_rng_state(prefix, data):
+    if prefix + "_keys" not in data:
+        return None
+    pos, has_gauss, cached_gaussian = data[prefix + "_rest"]
+    return "MT19937", data[prefix + "_keys"], int(pos), int(has_gauss), float(cached_gaussian)
+
+
+def env_rng(env):
+    """
+    The RandomState an env draws from (env.np_random for gym envs), or None.
+    """
+    rng = getattr(env, "np_random", None)
+    return rng if isinstance(rng, np.random.RandomState) else None
+
+
+def save_checkpoint(path, returns_sum, returns_count, episode, num_episodes, discount_factor, snapshots=None,
+                    env=None):
+    """
+    Writes the state of a Monte Carlo prediction run to path.
+
+    Args:
+        path: Checkpoint file (.npz).
+        returns_sum: Dense table of return sums.
+        returns_count: Dense table of return counts.
+        episode: Number of episodes accumulated into the tables.
+        num_episodes: Total number of episodes of the run.
+        discount_factor: Lambda discount factor of the run.
+        snapshots: (Optional) {episode count: [2, S] array of dense V and returns_count}.
+        env: (Optional) env whose RNG state is saved with the global np.random state.
+    """
+    arrays = {
+        "returns_sum": returns_sum,
+        "returns_count": returns_count,
+        "counters": np.array([episode, num_episodes], dtype=np.int64),
+        "discount_factor": np.array(discount_factor, dtype=np.float64),
+    }
+    for count, snapshot in (snapshots or {}).items():
+        arrays["snapshot_{}".format(count)] = snapshot
+    rng = env_rng(env)
+    _pack_rng_state("env_rng", rng.get_state() if rng is not None else None, arrays)
+    _pack_rng_state("global_rng", np.random.get_state(), arrays)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by save_checkpoint.
+
+    Returns:
+        A Checkpoint tuple.
+    """
+    with np.load(path) as data:
+        episode, num_episodes = data["counters"]
+        snapshots = {int(key[len("snapshot_"):]): data[key] for key in data.files if key.startswith("snapshot_")}
+        return Checkpoint(returns_sum=data["returns_sum"], returns_count=data["returns_count"],
+                          episode=int(episode), num_episodes=int(num_episodes),
+                          discount_factor=float(data["discount_factor"]),
+                          snapshots=dict(sorted(snapshots.items())),
+                          env_rng_state=_unpack_rng_state("env_rng", data),
+                          global_rng_state=_unpack_rng_state("global_rng", data))
+
+
+def restore_rng(checkpoint, env=None):
+    """
+    Puts the env RNG and np.random back into the state saved in the checkpoint.
+    """
+    rng = env_rng(env)
+    if rng is not None and checkpoint.env_rng_state is not None:
+        rng.set_state(checkpoint.env_rng_state)
+    if checkpoint.global_rng_state is not None:
+        np.random.set_state(checkpoint.global_rng_state)
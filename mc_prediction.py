@@ -1,19 +1,75 @@
 import gym
 import matplotlib
+import multiprocessing
 import numpy as np
+import os
 import sys
 
 from collections import defaultdict
+from scipy.stats import norm
 
 from gym.envs.denny.blackjack import BlackjackEnv
 from gym.envs.denny import plotting
+from blackjack_batch import simulate_batch
+from episode_buffer import EpisodeBuffer
+from mc_checkpoint import load_checkpoint, restore_rng, save_checkpoint
+from returns import batch_returns, concatenated_returns, discounted_returns
+from value_tables import BLACKJACK_SIZE, BlackjackValueView, ReturnStats, decode_blackjack, encode_blackjack
 
 matplotlib.style.use('ggplot')
 
+# Number of episode steps collected before they are added to the dense tables
+ACCUMULATE_EVERY = 10000
 
 
 
-def mc_prediction(policy, env, num_episodes, discount_factor=1.0, print_debug=False):
+
+def episode_returns(episode, discount_factor=1.0):
+    """
+    Discounted return G_t = r_t + discount_factor * G_t+1 for every timestep of an episode.
+
+    Args:
+        episode: List of [observation, action, reward, next_observation] steps.
+        discount_factor: Lambda discount factor.
+
+    Returns:
+        An array with the return of each timestep.
+    """
+    return discounted_returns([step[2] for step in episode], discount_factor)
+
+
+def accumulate_episodes(steps, lengths, returns_sum, returns_count, discount_factor=1.0, stats=None):
+    """
+    Adds the first-visit returns of a run of complete episodes to the dense tables
+    (see value_tables) in one np.add.at.
+
+    Args:
+        steps: Structured array of consecutive episodes from an EpisodeBuffer.
+        lengths: Length of every episode in steps.
+        returns_sum: Flat dense table of return sums, updated in place.
+        returns_count: Flat dense table of return counts, updated in place.
+        discount_factor: Lambda discount factor.
+        stats: (Optional) value_tables.ReturnStats that the returns are also added to.
+
+    Returns:
+        The flat indices of the first visited states, one entry per (episode, state).
+    """
+    # Returns of every timestep, restarting at the last step of every episode
+    returns = concatenated_returns(steps["reward"], lengths, discount_factor)
+
+    # First-visit: np.unique on (episode, state) keys gives the first occurrence of every state
+    states = encode_blackjack(steps["observation"])
+    episode_id = np.repeat(np.arange(len(lengths)), lengths)
+    _, first = np.unique(episode_id * BLACKJACK_SIZE + states, return_index=True)
+    np.add.at(returns_sum, states[first], returns[first])
+    np.add.at(returns_count, states[first], 1.0)
+    if stats is not None:
+        stats.update(states[first], returns[first])
+    return states[first]
+
+
+def mc_prediction(policy, env, num_episodes, discount_factor=1.0, print_debug=False, buffer=None,
+                  checkpoint_path=None, checkpoint_every=50000, snapshot_at=(), resume=False):
     """
     Monte Carlo prediction algorithm. Calculates the value function
     for a given policy using sampling.
@@ -23,49 +79,176 @@ def mc_prediction(policy, env, num_episodes, discount_factor=1.0, print_debug=Fa
         env: OpenAI gym environment.
         num_episodes: Nubmer of episodes to sample.
         discount_factor: Lambda discount factor.
+        buffer: (Optional) EpisodeBuffer that keeps every generated episode, e.g. to
+            replay them later. By default a scratch buffer is reused.
+        checkpoint_path: (Optional) file the run is checkpointed to (see mc_checkpoint), every
+            checkpoint_every episodes, at the snapshot_at counts and at the end.
+        checkpoint_every: Number of episodes between checkpoints.
+        snapshot_at: Episode counts at which a copy of V is added to the checkpoint,
+            see load_snapshots.
+        resume: Continue from checkpoint_path if it exists, see resume_mc_prediction.
+            The episodes of the buffer are not part of the checkpoint. Raises a ValueError
+            if the checkpoint was written with another discount_factor.
 
     Returns:
-        A dictionary that maps from state -> value.
+        A dictionary view that maps from state -> value.
         The state is a tuple and the value is a float.
     """
 
     # Keeps track of sum and count of returns for each state
     # to calculate an average. We could use an array to save all
     # returns (like in the book) but that's memory inefficient.
-    returns_sum = defaultdict(float)
-    returns_count = defaultdict(float)
-
-    # The final value function
-    V = defaultdict(float)
-    # defaultdict() by querying with V[state] you are adding "state" if it is not in V already.
-
-    for i in range(num_episodes):
+    # Dense tables indexed by encode_blackjack(state), see value_tables.
+    returns_sum = np.zeros(BLACKJACK_SIZE)
+    returns_count = np.zeros(BLACKJACK_SIZE)
+    start, snapshots = 0, {}
+
+    if snapshot_at and checkpoint_path is None:
+        raise ValueError("snapshot_at needs a checkpoint_path to write the snapshots to")
+    snapshot_at = set(snapshot_at)
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+        # the returns in the tables are already discounted, they can't be mixed with others
+        if checkpoint.discount_factor != discount_factor:
+            raise ValueError("The checkpoint was written with discount_factor={}, not {}".format(
+                checkpoint.discount_factor, discount_factor))
+        returns_sum, returns_count = checkpoint.returns_sum, checkpoint.returns_count
+        start, snapshots = checkpoint.episode, checkpoint.snapshots
+        restore_rng(checkpoint, env)
+
+    # Episodes are collected in the buffer and added to the tables a chunk at a time
+    keep_episodes = buffer is not None
+    if buffer is None:
+        buffer = EpisodeBuffer(obs_shape=(3,))
+    first_pending, pending_from = len(buffer), buffer.num_steps
+
+    for i in range(start, num_episodes):
         # Generate an episode
-        episode = generate_episode(env, print_debug)
+        episode = generate_episode(env, print_debug, policy, buffer)
         if print_debug: print("Episode generated: \n", episode)
 
-        # Accumulate data about each state from the episode
-        set_states = set()
-        for state, action, reward, next_state in episode:
-            set_states.add(state)  # need a unique list of states in the episode for V calc below.
+        # a checkpoint needs all episodes so far in the tables
+        checkpoint_now = checkpoint_path is not None and (
+            (i + 1) % checkpoint_every == 0 or i + 1 in snapshot_at or i == num_episodes - 1)
+        if buffer.num_steps - pending_from >= ACCUMULATE_EVERY or print_debug or checkpoint_now or \
+                i == num_episodes - 1:
+            set_states = accumulate_episodes(buffer.episodes(first_pending), buffer.lengths(first_pending),
+                                             returns_sum, returns_count, discount_factor)
+            if keep_episodes:
+                first_pending, pending_from = len(buffer), buffer.num_steps
+            else:
+                buffer.clear()
+
+        if checkpoint_now:
+            if i + 1 in snapshot_at:
+                V = value_view(returns_sum, returns_count)
+                snapshots[i + 1] = np.stack([V.values, returns_count])
+            save_checkpoint(checkpoint_path, returns_sum, returns_count, i + 1, num_episodes, discount_factor,
+                            snapshots, env)
+            print("\rEpisode {}/{}, checkpoint saved.".format(i + 1, num_episodes), end="")
+            sys.stdout.flush()
+
+        if print_debug: print("Return_count: \n", dict(BlackjackValueView(returns_count, returns_count)))
+        if print_debug: print("Return_sum: \n", dict(BlackjackValueView(returns_sum, returns_count)))
+        if print_debug: print("Set of states: \n", [decode_blackjack(s) for s in set_states])
+
+        if print_debug: print("V: \n", dict(value_view(returns_sum, returns_count)))
+
+    # Calculate average return for every state over all sampled episodes
+    return value_view(returns_sum, returns_count)
+
+
+def mc_prediction_adaptive(policy, env, target_half_width=0.05, confidence=0.95, fraction=1.0, min_visits=30,
+                           max_episodes=2000000, check_every=1000, discount_factor=1.0):
+    """
+    Monte Carlo prediction that runs until V is accurate enough instead of for a fixed
+    number of episodes. The variance of the returns of every state is tracked with Welford
+    updates (value_tables.ReturnStats) and every check_every episodes the run stops if the
+    confidence interval half-width of V is below target_half_width for the given fraction
+    of the visited states.
 
-        if print_debug: print("Return_count: \n", returns_count)
-        if print_debug: print("Return_sum: \n", returns_sum)
-        if print_debug: print("Set of states: \n", set_states)
+    Args:
+        policy: A function that maps an observation to action probabilities.
+        env: OpenAI gym environment.
+        target_half_width: Wanted half-width of the confidence interval of V(s).
+        confidence: Confidence level of the interval, e.g. 0.95.
+        fraction: Fraction of the visited states that have to reach the target. 1.0 means all
+            of them, which may take long for states that are rarely visited.
+        min_visits: States with fewer visits never count as converged (the variance
+            estimate is not reliable yet).
+        max_episodes: Upper limit on the number of episodes.
+        check_every: Number of episodes between checks of the stopping rule.
+        discount_factor: Lambda discount factor.
 
-        # Denny's implementation... quite different:
-        for state in set_states:
-            # Find the first occurance of the state in the episode
-            first_occurence_idx = next(i for i,x in enumerate(episode) if x[0] == state)
-            # Sum up all rewards since the first occurance
-            G = sum([x[2]*(discount_factor**i) for i,x in enumerate(episode[first_occurence_idx:])])
-            # Calculate average return for this state over all sampled episodes
-            returns_sum[state] += G
-            returns_count[state] += 1.0
-            V[state] = returns_sum[state] / returns_count[state]
+    Returns:
+        A tuple (V, half_width, num_episodes). V and half_width are dictionary views that map
+        from state -> value and state -> half-width of its confidence interval.
+    """
+    returns_sum = np.zeros(BLACKJACK_SIZE)
+    returns_count = np.zeros(BLACKJACK_SIZE)
+    stats = ReturnStats(BLACKJACK_SIZE)
+    z = norm.ppf(0.5 + confidence / 2)
+    buffer = EpisodeBuffer(obs_shape=(3,))
+    # what is returned when max_episodes = 0: no episodes and nothing estimated yet
+    half_width = np.full(BLACKJACK_SIZE, np.inf)
+    i = -1
+
+    for i in range(max_episodes):
+        generate_episode(env, False, policy, buffer)
+        if (i + 1) % check_every != 0 and i != max_episodes - 1:
+            continue
+
+        accumulate_episodes(buffer.episodes(), buffer.lengths(), returns_sum, returns_count, discount_factor, stats)
+        buffer.clear()
+        half_width = stats.half_width(z)
+        half_width[stats.count < min_visits] = np.inf
+        visited = returns_count > 0
+        if np.mean(half_width[visited] <= target_half_width) >= fraction:
+            break
+
+    return value_view(returns_sum, returns_count), BlackjackValueView(half_width, returns_count), i + 1
+
+
+def resume_mc_prediction(policy, env, checkpoint_path, num_episodes=None, **kwargs):
+    """
+    Continues a checkpointed mc_prediction run with the same discount factor, from the
+    episode and RNG states of the checkpoint. The env should be a fresh instance of the
+    env of the original run.
+
+    Args:
+        policy: The policy of the original run.
+        env: OpenAI gym environment.
+        checkpoint_path: Checkpoint written by mc_prediction.
+        num_episodes: (Optional) new total number of episodes, e.g. to extend a finished run.
+        **kwargs: Other mc_prediction arguments (checkpoint_every, snapshot_at, ...).
+
+    Returns:
+        A dictionary view that maps from state -> value.
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    num_episodes = checkpoint.num_episodes if num_episodes is None else num_episodes
+    return mc_prediction(policy, env, num_episodes, checkpoint.discount_factor, checkpoint_path=checkpoint_path,
+                         resume=True, **kwargs)
+
+
+def load_snapshots(checkpoint_path):
+    """
+    The V snapshots of a checkpointed run, e.g. to plot how V converges while it runs.
+
+    Returns:
+        A dictionary that maps from episode count -> V dictionary view.
+    """
+    return {count: BlackjackValueView(V, returns_count)
+            for count, (V, returns_count) in load_checkpoint(checkpoint_path).snapshots.items()}
+
+
+def value_view(returns_sum, returns_count):
+    """
+    Dict view of the value function V = returns_sum / returns_count for dense tables.
+    """
+    V = np.divide(returns_sum, returns_count, out=np.zeros(BLACKJACK_SIZE), where=returns_count > 0)
+    return BlackjackValueView(V, returns_count)
 
-        if print_debug: print("V: \n", V)
-    return V
 
 def mc_prediction_original(policy, env, num_episodes, discount_factor=1.0, print_debug=False):
     """
@@ -95,28 +278,25 @@ def mc_prediction_original(policy, env, num_episodes, discount_factor=1.0, print
 
     for i in range(num_episodes):
         # Generate an episode
-        episode = generate_episode(env, print_debug)
+        episode = generate_episode(env, print_debug, policy)
         if print_debug: print ("Episode generated: \n", episode)
 
-        # Accumulate data about each state from the episode
+        # Returns of every timestep in one backward pass: G_t = r_t + discount_factor * G_t+1
+        returns = episode_returns(episode, discount_factor)
+
+        # Every-visit updates in one forward pass, using the incremental mean:
+        # V(S) = V(S) + (1/N)(G_t - V(S))
         set_states = set()
-        for state, action, reward, next_state in episode:
-            returns_count[state] +=1
-            returns_sum[state] += reward # the associated reward for each episode/game the state was involved in.
-            set_states.add(state) # need a unique list of states in the episode for V calc below.
+        for t, (state, action, reward, next_state) in enumerate(episode):
+            returns_count[state] += 1
+            returns_sum[state] += returns[t]
+            V[state] = V[state] + (1/returns_count[state]) * (returns[t] - V[state])
+            set_states.add(state)
 
         if print_debug: print("Return_count: \n", returns_count)
         if print_debug: print("Return_sum: \n", returns_sum)
         if print_debug: print("Set of states: \n", set_states)
 
-        # Calculate V for each state in episode using: V(S) = V(S) + (1/N)(G_t - V(S))
-        # Analysis: I appear to be doing every instance of state implementation, and my return calc is wrong.
-        # I am also using incremental mean... which probably works for every instance...?
-        # In Text every instance is covered in ch7 so stick with first instance for now.
-        for state in set_states:
-            if returns_count[state] > 0:
-                V[state] = V[state] + (1/returns_count[state]) * (returns_sum[state] - V[state])
-
         if print_debug: print("V: \n", V)
     return V
 
@@ -133,36 +313,184 @@ def sample_policy(observation):
     # Stick (action 0) if the score is > 20, hit (action 1) otherwise
     return 0 if score >= 20 else 1
 
+def sample_policy_batch(score, dealer_score, usable_ace):
+    """
+    Vectorized sample_policy for blackjack_batch: arrays of observations in, array of actions out.
+    """
+    return np.where(score >= 20, 0, 1)
+
 def print_observation(observation):
     score, dealer_score, usable_ace = observation
     print("Player Score: {} (Usable Ace: {}), Dealer Score: {}".format(
           score, usable_ace, dealer_score))
 
-def generate_episode(env, print_debug):
+def generate_episode(env, print_debug, policy=sample_policy, buffer=None):
+    """
+    Plays one episode. Without a buffer the episode is returned as a list of
+    [observation, action, reward, next_observation] steps. With an EpisodeBuffer the
+    steps are appended to it and the episode is returned as a view into the buffer.
+    """
     observation = env.reset()
     episode = []
     while True:
         if print_debug: print_observation(observation)
-        action = sample_policy(observation)
+        action = policy(observation)
         if print_debug: print("Taking action: {}".format( ["Stick", "Hit"][action]))
         next_observation, reward, done, _ = env.step(action)
-        episode.append([observation, action, reward, next_observation])
+        if buffer is None:
+            episode.append([observation, action, reward, next_observation])
+        else:
+            buffer.add(observation, action, reward, done)
         observation = next_observation
         if done:
             if print_debug: print_observation(observation)
             if print_debug: print("Game end. Reward: {}\n".format(float(reward)))
             break
-    return episode
+    return episode if buffer is None else buffer.episode(-1)
+
+def _mc_worker(args):
+    """
+    One shard of mc_prediction_parallel: runs num_episodes on its own env and RNG stream
+    and returns the partial (returns_sum, returns_count) tables.
+    """
+    policy, make_env, num_episodes, discount_factor, seed_seq = args
+    env = make_env()
+    seed = int(seed_seq.generate_state(1)[0])
+    env.seed(seed)
+    # for policies that sample actions with np.random
+    np.random.seed(seed)
+
+    returns_sum = np.zeros(BLACKJACK_SIZE)
+    returns_count = np.zeros(BLACKJACK_SIZE)
+    buffer = EpisodeBuffer(obs_shape=(3,))
+    for i in range(num_episodes):
+        generate_episode(env, False, policy, buffer)
+        if buffer.num_steps >= ACCUMULATE_EVERY or i == num_episodes - 1:
+            accumulate_episodes(buffer.episodes(), buffer.lengths(), returns_sum, returns_count, discount_factor)
+            buffer.clear()
+    return returns_sum, returns_count
 
-env = BlackjackEnv()
 
-#mc_prediction(sample_policy, env, num_episodes=10, discount_factor=1.0, print_debug=True)
+def mc_prediction_parallel(policy, make_env, num_episodes, discount_factor=1.0, n_workers=None, seed=None):
+    """
+    First-visit Monte Carlo prediction with episodes generated on a process pool.
+    Every worker owns an env and an independent RNG stream and returns partial
+    returns_sum / returns_count tables, which are merged into V.
 
-# V_100 = mc_prediction(sample_policy, env, num_episodes=100)
-# plotting.plot_value_function(V_100, title="100 Steps")
+    Args:
+        policy: A picklable (module level) function that maps an observation to an action.
+        make_env: A picklable callable returning a new env, e.g. BlackjackEnv.
+        num_episodes: Nubmer of episodes to sample in total.
+        discount_factor: Lambda discount factor.
+        n_workers: Number of worker processes. Defaults to the number of cores.
+        seed: Seed of the root RNG stream; None for a fresh random seed.
+
+    Returns:
+        A dictionary view that maps from state -> value.
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    shards = [num_episodes // n_workers + (1 if i < num_episodes % n_workers else 0) for i in range(n_workers)]
+    seeds = np.random.SeedSequence(seed).spawn(n_workers)
 
-# V_10k = mc_prediction(sample_policy, env, num_episodes=10000)
-# plotting.plot_value_function(V_10k, title="10,000 Steps")
+    with multiprocessing.Pool(n_workers) as pool:
+        partials = pool.map(_mc_worker, [(policy, make_env, n, discount_factor, s) for n, s in zip(shards, seeds)])
 
-V_500k = mc_prediction(sample_policy, env, num_episodes=500000)
-plotting.plot_value_function(V_500k, title="500,000 Steps")
\ No newline at end of file
+    # the dense tables of the shards simply add up
+    returns_sum = sum(partial_sum for partial_sum, partial_count in partials)
+    returns_count = sum(partial_count for partial_sum, partial_count in partials)
+    return value_view(returns_sum, returns_count)
+
+
+def mc_prediction_vectorized(policy, num_episodes, discount_factor=1.0, batch_size=100000, seed=None,
+                             natural=False):
+    """
+    First-visit Monte Carlo prediction on the vectorized Blackjack simulator: hands are
+    played batch_size at a time in lockstep and the padded trajectories are accumulated
+    with array operations only.
+
+    Args:
+        policy: Vectorized policy, see blackjack_batch.simulate_batch and sample_policy_batch.
+        num_episodes: Nubmer of episodes to sample.
+        discount_factor: Lambda discount factor.
+        batch_size: Number of hands simulated together.
+        seed: Seed for the card draws.
+        natural: Pay 1.5 for a winning natural, as BlackjackEnv(natural=True).
+
+    Returns:
+        A dictionary view that maps from state -> value.
+    """
+    rng = np.random.default_rng(seed)
+    returns_sum = np.zeros(BLACKJACK_SIZE)
+    returns_count = np.zeros(BLACKJACK_SIZE)
+
+    for start in range(0, num_episodes, batch_size):
+        batch = simulate_batch(policy, min(batch_size, num_episodes - start), rng, natural)
+
+        # G_t = r_t + discount_factor * G_t+1 for all hands at once; padding rewards are 0
+        returns = batch_returns(batch.rewards, discount_factor=discount_factor)
+
+        # first visit of every (hand, state) pair among the real (unpadded) steps
+        states = encode_blackjack(batch.observations)
+        hand = np.broadcast_to(np.arange(len(states))[:, None], states.shape)
+        keys = (hand * BLACKJACK_SIZE + states)[batch.mask]
+        _, first = np.unique(keys, return_index=True)
+        np.add.at(returns_sum, states[batch.mask][first], returns[batch.mask][first])
+        np.add.at(returns_count, states[batch.mask][first], 1.0)
+
+    return value_view(returns_sum, returns_count)
+
+
+# The demo only runs as a script: the process pool of mc_prediction_parallel re-imports this module in its workers.
+if __name__ == "__main__":
+    import tempfile
+
+    def seeded_env(seed=0):
+        np.random.seed(seed)
+        env = BlackjackEnv()
+        env.seed(seed)
+        return env
+
+    # Test: a run stopped after 1000 episodes and resumed from its checkpoint ends bit-identical
+    # to the same run done in one go (tables and snapshots), as long as the env is fresh
+    with tempfile.TemporaryDirectory() as tmp:
+        straight_path, resumed_path = os.path.join(tmp, "straight.npz"), os.path.join(tmp, "resumed.npz")
+        V_straight = mc_prediction(sample_policy, seeded_env(), 2000, discount_factor=0.9,
+                                   checkpoint_path=straight_path, checkpoint_every=500, snapshot_at=(1500,))
+        mc_prediction(sample_policy, seeded_env(), 1000, discount_factor=0.9, checkpoint_path=resumed_path,
+                      checkpoint_every=500)
+        np.random.seed(1)  # whatever happens in between, the checkpoint restores the RNG states
+        V_resumed = resume_mc_prediction(sample_policy, BlackjackEnv(), resumed_path, num_episodes=2000,
+                                         checkpoint_every=500, snapshot_at=(1500,))
+        np.testing.assert_array_equal(V_resumed.values, V_straight.values)
+        np.testing.assert_array_equal(V_resumed.counts, V_straight.counts)
+        np.testing.assert_array_equal(load_snapshots(resumed_path)[1500].values,
+                                      load_snapshots(straight_path)[1500].values)
+
+        # Test: resuming with another discount factor is refused
+        try:
+            mc_prediction(sample_policy, BlackjackEnv(), 3000, discount_factor=1.0, checkpoint_path=resumed_path,
+                          resume=True)
+            raise AssertionError("resumed with a different discount factor")
+        except ValueError:
+            pass
+    print("")
+
+    env = BlackjackEnv()
+
+    #mc_prediction(sample_policy, env, num_episodes=10, discount_factor=1.0, print_debug=True)
+
+    # V_100 = mc_prediction(sample_policy, env, num_episodes=100)
+    # plotting.plot_value_function(V_100, title="100 Steps")
+
+    # V_10k = mc_prediction(sample_policy, env, num_episodes=10000)
+    # plotting.plot_value_function(V_10k, title="10,000 Steps")
+
+    # V_500k = mc_prediction_parallel(sample_policy, BlackjackEnv, num_episodes=500000)
+    # V_500k = mc_prediction_vectorized(sample_policy_batch, num_episodes=500000)
+    # Restartable: V_500k = resume_mc_prediction(sample_policy, BlackjackEnv(), "mc_500k.npz") after a crash
+    # V_500k = mc_prediction(sample_policy, env, num_episodes=500000, checkpoint_path="mc_500k.npz",
+    #                        snapshot_at=(10000, 100000), resume=True)
+    # Stops once V(s) is known to +-0.05 for 95% of the states:
+    # V, half_width, num_episodes = mc_prediction_adaptive(sample_policy, env, fraction=0.95)
+    V_500k = mc_prediction(sample_policy, env, num_episodes=500000)
+    plotting.plot_value_function(V_500k, title="500,000 Steps")
\ No newline at end of file
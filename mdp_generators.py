@@ -0,0 +1,78 @@
+import numpy as np
+import scipy.sparse
+
+from mdp_model import CompiledMDP
+
+"""
+Synthetic MDPs of any size for testing and benchmarking the DP solvers.
+The generators build the CompiledMDP arrays directly (no env.P dict), so they scale to
+millions of states. The result can be passed anywhere an env is accepted by the solvers.
+"""
+
+UP = 0
+RIGHT = 1
+DOWN = 2
+LEFT = 3
+
+
+def gridworld_mdp(shape=(4, 4)):
+    """
+    Denny Britz's GridworldEnv for an arbitrary grid: the top left and bottom right
+    states are terminal, every other step costs -1, moving off the grid leaves the
+    agent where it is.
+
+    Args:
+        shape: (rows, columns) of the grid.
+
+    Returns:
+        A CompiledMDP with nS = rows * columns and nA = 4 (0=up, 1=right, 2=down, 3=left).
+    """
+    max_y, max_x = shape
+    nS, nA = max_y * max_x, 4
+    s = np.arange(nS)
+    y, x = s // max_x, s % max_x
+
+    next_state = np.empty((nS, nA), dtype=np.int64)
+    next_state[:, UP] = np.where(y == 0, s, s - max_x)
+    next_state[:, RIGHT] = np.where(x == max_x - 1, s, s + 1)
+    next_state[:, DOWN] = np.where(y == max_y - 1, s, s + max_x)
+    next_state[:, LEFT] = np.where(x == 0, s, s - 1)
+
+    terminal = (s == 0) | (s == nS - 1)
+    next_state[terminal] = s[terminal, None]
+    R = np.repeat(np.where(terminal, 0.0, -1.0), nA)
+
+    # deterministic: exactly one transition per (s, a)
+    P = scipy.sparse.csr_matrix(
+        (np.ones(nS * nA), next_state.ravel(), np.arange(nS * nA + 1)), shape=(nS * nA, nS))
+    return CompiledMDP(P, R, terminal, nA)
+
+
+def random_sparse_mdp(nS, nA=4, branching=3, seed=None):
+    """
+    Random sparse MDP: every (s, a) moves to `branching` uniformly drawn next states with
+    random probabilities and has a standard normal expected reward. There are no terminal
+    states, so use a discount_factor < 1 with it.
+
+    Args:
+        nS: Number of states.
+        nA: Number of actions.
+        branching: Number of (not necessarily distinct) next states of every (s, a).
+        seed: Seed for the random generator.
+
+    Returns:
+        A CompiledMDP.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = nS * nA
+    next_state = rng.integers(0, nS, size=(n_rows, branching))
+    prob = rng.random((n_rows, branching)) + 1e-3
+    prob /= prob.sum(axis=1, keepdims=True)
+
+    P = scipy.sparse.csr_matrix(
+        (prob.ravel(), next_state.ravel(), np.arange(0, n_rows * branching + 1, branching)),
+        shape=(n_rows, nS))
+    # duplicate next states of the same (s, a) are merged
+    P.sum_duplicates()
+    R = rng.standard_normal(n_rows)
+    return CompiledMDP(P, R, np.zeros(nS, dtype=bool), nA)
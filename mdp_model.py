@@ -0,0 +1,287 @@
+import weakref
+
+import numpy as np
+import scipy.sparse
+
+"""
+Compiled (array based) form of a tabular MDP for the DP solvers.
+env.P is a nested dict: env.P[s][a] is a list of (prob, next_state, reward, done) tuples.
+Walking it in Python on every sweep is slow, so we flatten it once into a sparse matrix
+P[s*nA + a, s'] plus dense expected reward and terminal arrays and then run every sweep
+as a sparse mat-vec.
+"""
+
+# One compiled model per env object, so repeated calls (e.g. policy evaluation inside
+# policy iteration) only pay for the dict walk once.
+_compiled_cache = weakref.WeakKeyDictionary()
+
+
+class CompiledMDP():
+    """
+    Sparse representation of a tabular MDP.
+
+    Attributes:
+        P: [S*A, S] scipy.sparse CSR matrix. Row s*nA + a holds the transition
+            probabilities of taking action a in state s.
+        R: Vector of length S*A with the expected immediate reward of each (s, a).
+        terminal: Boolean vector of length S. True for absorbing terminal states,
+            i.e. every action loops back to the state itself and ends the episode.
+        nS: Number of states.
+        nA: Number of actions.
+    """
+
+    def __init__(self, P, R, terminal, nA):
+        self.P = scipy.sparse.csr_matrix(P)
+        self.R = np.asarray(R, dtype=float)
+        self.terminal = np.asarray(terminal, dtype=bool)
+        self.nA = nA
+        self.nS = self.P.shape[1]
+
+    def q_values(self, V, discount_factor=1.0, states=None):
+        """
+        One Bellman backup for all state-action pairs, or only for those of the given states.
+
+        Returns:
+            [S, A] matrix with Q[s, a] = R(s, a) + discount_factor * sum_s' P(s'|s, a) V[s'],
+            or [len(states), A] with the rows of states.
+        """
+        if states is None:
+            return (self.R + discount_factor * self.P.dot(V)).reshape(self.nS, self.nA)
+        rows = (np.asarray(states)[:, None] * self.nA + np.arange(self.nA)).ravel()
+        return (self.R[rows] + discount_factor * self.P[rows].dot(V)).reshape(-1, self.nA)
+
+    def policy_model(self, policy):
+        """
+        Collapses the MDP onto a fixed policy.
+
+        Args:
+            policy: [S, A] shaped matrix representing the policy.
+
+        Returns:
+            A tuple (P_pi, R_pi): the [S, S] sparse state transition matrix and the
+            expected reward vector of length S when following the policy.
+        """
+        # Pi[s, s*nA + a] = policy[s][a], so Pi @ P averages the action rows of each state
+        Pi = scipy.sparse.csr_matrix(
+            (np.array(policy, dtype=float).ravel(),
+             np.arange(self.nS * self.nA),
+             np.arange(0, self.nS * self.nA + 1, self.nA)),
+            shape=(self.nS, self.nS * self.nA))
+        Pi.eliminate_zeros()
+        return Pi.dot(self.P).tocsr(), Pi.dot(self.R)
+
+    def predecessors(self):
+        """
+        Predecessor index: which states can reach s' in one step under some action.
+
+        Returns:
+            [S, S] scipy.sparse CSR matrix. The column indices of row s' are the
+            predecessor states of s' (indices[indptr[s']:indptr[s'+1]]).
+        """
+        P = self.P.tocoo()
+        pred = scipy.sparse.csr_matrix(
+            (np.ones_like(P.data), (P.col, P.row // self.nA)), shape=(self.nS, self.nS))
+        pred.sum_duplicates()
+        return pred
+
+
+class MemmapMDP():
+    """
+    Out-of-core tabular MDP backed by a file written with save_mdp. The transition arrays
+    are np.memmap views and are streamed in chunks of states, so only V, the Q values
+    and one chunk of transitions need to fit in memory.
+
+    Attributes:
+        indptr: [S*A + 1] int64, transitions of (s, a) are entries indptr[s*nA+a] .. indptr[s*nA+a+1]-1.
+        next_state: [nnz] int64 next state of every transition.
+        prob: [nnz] float64 transition probabilities.
+        reward: [nnz] float64 rewards.
+        done: [nnz] uint8 episode termination flags.
+        nS: Number of states.
+        nA: Number of actions.
+        chunk_size: Number of states read per chunk.
+    """
+
+    def __init__(self, path, chunk_size=65536):
+        header = np.fromfile(path, dtype=np.int64, count=4)
+        if header[0] != _MDP_MAGIC:
+            raise ValueError("{} is not an MDP file written by save_mdp".format(path))
+        self.nS, self.nA, nnz = int(header[1]), int(header[2]), int(header[3])
+        self.chunk_size = chunk_size
+        for name, dtype, count, offset in _mdp_layout(self.nS, self.nA, nnz):
+            setattr(self, name, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,)))
+
+    def iter_q_values(self, V, discount_factor=1.0):
+        """
+        Streams one Bellman backup over the file.
+
+        Yields:
+            Tuples (lo, hi, Q) where Q is the [hi - lo, A] block of action values of states lo .. hi-1.
+        """
+        nA = self.nA
+        for lo in range(0, self.nS, self.chunk_size):
+            hi = min(lo + self.chunk_size, self.nS)
+            indptr = np.array(self.indptr[lo * nA:hi * nA + 1])
+            start, stop = indptr[0], indptr[-1]
+            contrib = self.prob[start:stop] * (
+                self.reward[start:stop] + discount_factor * V[self.next_state[start:stop]])
+            row = np.repeat(np.arange((hi - lo) * nA), np.diff(indptr))
+            q = np.bincount(row, weights=contrib, minlength=(hi - lo) * nA)
+            yield lo, hi, q.reshape(hi - lo, nA)
+
+    def q_values(self, V, discount_factor=1.0):
+        """
+        One Bellman backup for all state-action pairs, see CompiledMDP.q_values.
+        """
+        Q = np.empty((self.nS, self.nA))
+        for lo, hi, q in self.iter_q_values(V, discount_factor):
+            Q[lo:hi] = q
+        return Q
+
+
+# "RLDBMDP1" as a little endian int64
+_MDP_MAGIC = int(np.frombuffer(b"RLDBMDP1", dtype="<i8")[0])
+_HEADER_BYTES = 4 * 8
+
+
+def _mdp_layout(nS, nA, nnz):
+    """
+    File layout after the header: (name, dtype, count, byte offset) of every array.
+    """
+    layout, offset = [], _HEADER_BYTES
+    for name, dtype, count in [("indptr", np.int64, nS * nA + 1), ("next_state", np.int64, nnz),
+                               ("prob", np.float64, nnz), ("reward", np.float64, nnz),
+                               ("done", np.uint8, nnz)]:
+        layout.append((name, dtype, count, offset))
+        offset += count * np.dtype(dtype).itemsize
+    return layout
+
+
+def save_mdp(env, path, chunk_size=65536):
+    """
+    Writes an MDP to disk as fixed width arrays (see MemmapMDP) without building it in memory.
+
+    Args:
+        env: OpenAI env with nS, nA and P, or a CompiledMDP. A CompiledMDP only keeps the
+            expected reward of each (s, a), which is stored as the reward of all its
+            transitions, and done is set for transitions into terminal states.
+        path: File to write.
+        chunk_size: Number of states written per chunk.
+
+    Returns:
+        A MemmapMDP reading the new file.
+    """
+    nS, nA = env.nS, env.nA
+    if isinstance(env, CompiledMDP):
+        nnz = env.P.nnz
+    else:
+        # first pass only counts transitions so the file can be laid out up front
+        nnz = sum(len(env.P[s][a]) for s in range(nS) for a in range(nA))
+
+    layout = _mdp_layout(nS, nA, nnz)
+    total = layout[-1][3] + nnz
+    out = np.memmap(path, dtype=np.uint8, mode="w+", shape=(total,))
+    out[:_HEADER_BYTES] = np.array([_MDP_MAGIC, nS, nA, nnz], dtype=np.int64).view(np.uint8)
+    arrays = {name: np.ndarray((count,), dtype=dtype, buffer=out, offset=offset)
+              for name, dtype, count, offset in layout}
+
+    if isinstance(env, CompiledMDP):
+        P = env.P
+        arrays["indptr"][:] = P.indptr
+        for start in range(0, nnz, chunk_size * nA):
+            stop = min(start + chunk_size * nA, nnz)
+            arrays["next_state"][start:stop] = P.indices[start:stop]
+            arrays["prob"][start:stop] = P.data[start:stop]
+        row = np.repeat(np.arange(nS * nA), np.diff(P.indptr))
+        arrays["reward"][:] = env.R[row]
+        arrays["done"][:] = env.terminal[P.indices]
+    else:
+        arrays["indptr"][0] = 0
+        entry = 0
+        for lo in range(0, nS, chunk_size):
+            counts, transitions = [], []
+            for s in range(lo, min(lo + chunk_size, nS)):
+                for a in range(nA):
+                    counts.append(len(env.P[s][a]))
+                    transitions.extend(env.P[s][a])
+            t = np.array(transitions, dtype=float).reshape(-1, 4)
+            n = len(t)
+            arrays["indptr"][lo * nA + 1:lo * nA + 1 + len(counts)] = entry + np.cumsum(counts)
+            arrays["prob"][entry:entry + n] = t[:, 0]
+            arrays["next_state"][entry:entry + n] = t[:, 1]
+            arrays["reward"][entry:entry + n] = t[:, 2]
+            arrays["done"][entry:entry + n] = t[:, 3]
+            entry += n
+
+    out.flush()
+    del arrays, out
+    return MemmapMDP(path, chunk_size)
+
+
+def compile_mdp(env):
+    """
+    Compiles env.P into a CompiledMDP. The result is cached per env object.
+
+    Args:
+        env: OpenAI env with nS, nA and P, where env.P[s][a] is a list of
+            (prob, next_state, reward, done) tuples. A CompiledMDP or a MemmapMDP
+            is returned as is.
+
+    Returns:
+        A CompiledMDP.
+    """
+    if isinstance(env, (CompiledMDP, MemmapMDP)):
+        return env
+    try:
+        return _compiled_cache[env]
+    except (KeyError, TypeError):
+        pass
+
+    nS, nA = env.nS, env.nA
+    rows, cols, probs = [], [], []
+    R = np.zeros(nS * nA)
+    terminal = np.zeros(nS, dtype=bool)
+
+    for s in range(nS):
+        absorbing = True
+        for a in range(nA):
+            sa = s * nA + a
+            for prob, next_state, reward, done in env.P[s][a]:
+                rows.append(sa)
+                cols.append(next_state)
+                probs.append(prob)
+                R[sa] += prob * reward
+                absorbing = absorbing and done and next_state == s
+        terminal[s] = absorbing
+
+    # duplicate (sa, s') entries are summed by the COO -> CSR conversion
+    P = scipy.sparse.coo_matrix((probs, (rows, cols)), shape=(nS * nA, nS)).tocsr()
+    mdp = CompiledMDP(P, R, terminal, nA)
+
+    try:
+        _compiled_cache[env] = mdp
+    except TypeError:
+        pass
+    return mdp
+
+
+# The checks only run as a script. policy_evaluation imports this module, so they import it
+# back by name: the MemmapMDP it checks for has to be mdp_model.MemmapMDP, not __main__'s.
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from gym.envs.denny.gridworld import GridworldEnv
+    from mdp_generators import random_sparse_mdp
+    from mdp_model import save_mdp
+    from policy_evaluation import policy_eval_pm
+
+    # Test: evaluating a policy on the saved file gives the values of the in-memory model,
+    # for an env.P model (streamed) and a CompiledMDP (written from its arrays)
+    with tempfile.TemporaryDirectory() as tmp:
+        for env, discount_factor in [(GridworldEnv(), 1.0), (random_sparse_mdp(1000, seed=0), 0.9)]:
+            random_policy = np.ones([env.nS, env.nA]) / env.nA
+            mdp = save_mdp(env, os.path.join(tmp, "mdp.bin"), chunk_size=7)
+            np.testing.assert_allclose(policy_eval_pm(random_policy, mdp, discount_factor),
+                                       policy_eval_pm(random_policy, env, discount_factor), atol=1e-8)
+            del mdp
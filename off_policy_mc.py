@@ -0,0 +1,210 @@
+import matplotlib
+import numpy as np
+
+from gym.envs.denny.blackjack import BlackjackEnv
+from gym.envs.denny import plotting
+from episode_buffer import EpisodeBuffer
+from mc_prediction import generate_episode, sample_policy
+from returns import batch_returns
+from value_tables import BLACKJACK_SIZE, BlackjackValueView, decode_blackjack, encode_blackjack
+
+matplotlib.style.use('ggplot')
+
+"""
+Off-policy Monte Carlo evaluation and control with incremental weighted importance sampling
+(Sutton & Barto 5.6 / 5.7) on stored Blackjack trajectories.
+Episodes of a behavior policy b are generated once into an EpisodeBuffer and can then score
+any number of target policies. Policies are dense [BLACKJACK_SIZE, nA] tables of action
+probabilities (see policy_table), so all target policies are updated together: the
+backward pass runs over the timesteps of a batch of episodes for all K targets at once
+and ends as soon as every importance weight is zero.
+"""
+
+
+def policy_table(policy, nA=2):
+    """
+    Dense table of the action probabilities of a Blackjack policy.
+
+    Args:
+        policy: A function that maps an observation to action probabilities, or to an
+            action (deterministic policy, e.g. mc_prediction.sample_policy).
+        nA: Number of actions.
+
+    Returns:
+        A [BLACKJACK_SIZE, nA] array.
+    """
+    table = np.zeros([BLACKJACK_SIZE, nA])
+    for s in range(BLACKJACK_SIZE):
+        probs = policy(decode_blackjack(s))
+        if np.ndim(probs) == 0:
+            table[s, probs] = 1.0
+        else:
+            table[s] = probs
+    return table
+
+
+def make_table_policy(table):
+    """
+    A policy for generate_episode that samples its action from a policy table.
+    """
+    def policy_fn(observation):
+        probs = table[encode_blackjack(observation)]
+        return np.random.choice(len(probs), p=probs)
+    return policy_fn
+
+
+def _padded_batch(buffer, start, stop):
+    """
+    Episodes start .. stop-1 of the buffer as zero padded [N, T] arrays of flat states,
+    actions and rewards, and the [N, T] mask of the real steps.
+    """
+    steps = buffer.episodes(start, stop)
+    lengths = buffer.lengths(start, stop)
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    states = np.zeros(mask.shape, dtype=np.int64)
+    actions = np.zeros(mask.shape, dtype=np.int64)
+    rewards = np.zeros(mask.shape)
+    states[mask] = encode_blackjack(steps["observation"])
+    actions[mask] = steps["action"]
+    rewards[mask] = steps["reward"]
+    return states, actions, rewards, mask
+
+
+def _merge(Q, C, index, weights, weighted_returns):
+    """
+    Adds samples to the weighted averages Q with total weights C (flat views, in place).
+    Q <- Q + W / C * (G - Q) for every sample is the same as the weighted average over
+    all of them, so a whole timestep of a batch is added at once.
+    """
+    sum_w = np.bincount(index, weights, minlength=len(C))
+    sum_wg = np.bincount(index, weighted_returns, minlength=len(C))
+    updated = sum_w > 0
+    C[updated] += sum_w[updated]
+    Q[updated] += sum_w[updated] / C[updated] * (sum_wg[updated] / sum_w[updated] - Q[updated])
+
+
+def off_policy_mc_prediction(buffer, behavior, targets, discount_factor=1.0, batch_size=100000, Q=None, C=None):
+    """
+    Off-policy Monte Carlo evaluation of several target policies from the episodes of one
+    behavior policy, using weighted importance sampling.
+
+    Args:
+        buffer: EpisodeBuffer with Blackjack episodes generated by the behavior policy.
+        behavior: [BLACKJACK_SIZE, nA] policy table of the behavior policy. It has to give
+            a non-zero probability to every action a target policy can take.
+        targets: [K, BLACKJACK_SIZE, nA] policy tables of the target policies.
+        discount_factor: Gamma discount factor.
+        batch_size: Number of episodes processed together.
+        Q, C: (Optional) estimates and cumulative weights [K, BLACKJACK_SIZE, nA] of an
+            earlier call, to continue with new episodes. Updated in place.
+
+    Returns:
+        A tuple (Q, C, value). Q[k] is the action-value function of target k, C[k] the
+        cumulative importance weights and value[k] the weighted importance sampling
+        estimate of the expected return of an episode under target k.
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    K, nS, nA = targets.shape
+    Q = np.zeros([K, nS, nA]) if Q is None else Q
+    C = np.zeros([K, nS, nA]) if C is None else C
+    Q_flat, C_flat = Q.reshape(-1), C.reshape(-1)
+    # importance ratio pi_k(a|s) / b(a|s) of every (state, action)
+    ratio = np.divide(targets, behavior, out=np.zeros_like(targets), where=behavior > 0).reshape(K, -1)
+    offsets = (np.arange(K) * nS * nA)[:, None]
+    value_num, value_den = np.zeros(K), np.zeros(K)
+
+    for start in range(0, len(buffer), batch_size):
+        states, actions, rewards, mask = _padded_batch(buffer, start, min(start + batch_size, len(buffer)))
+        returns = batch_returns(rewards, discount_factor=discount_factor, mask=mask)
+        sa = states * nA + actions
+
+        # W[k, n]: product of the ratios after timestep t of episode n under target k
+        W = np.ones([K, len(sa)])
+        for t in range(sa.shape[1] - 1, -1, -1):
+            live = mask[:, t] & (W > 0)
+            k, n = np.nonzero(live)
+            _merge(Q_flat, C_flat, offsets[k, 0] + sa[n, t], W[k, n], W[k, n] * returns[n, t])
+            W[:, mask[:, t]] *= ratio[:, sa[mask[:, t], t]]
+            # stop early once no episode has weight left
+            if not W.any():
+                break
+
+        # W now weighs the whole episode (zero rows stay zero even after an early stop)
+        value_num += W @ returns[:, 0]
+        value_den += W.sum(axis=1)
+
+    value = np.divide(value_num, value_den, out=np.zeros(K), where=value_den > 0)
+    return Q, C, value
+
+
+def off_policy_mc_control(buffer, behavior, discount_factor=1.0, batch_size=1000, Q=None, C=None):
+    """
+    Off-policy Monte Carlo control with weighted importance sampling: finds the greedy
+    policy from the stored episodes of a behavior policy.
+    The backward pass of the episodes of a batch runs in lockstep, so the greedy policy is
+    updated once per timestep of a batch; with batch_size=1 this is exactly the per-episode
+    algorithm of Sutton & Barto 5.7.
+
+    Args:
+        buffer: EpisodeBuffer with Blackjack episodes generated by the behavior policy.
+        behavior: [BLACKJACK_SIZE, nA] policy table of the behavior policy (soft, e.g. random).
+        discount_factor: Gamma discount factor.
+        batch_size: Number of episodes processed together.
+        Q, C: (Optional) [BLACKJACK_SIZE, nA] tables of an earlier call. Updated in place.
+
+    Returns:
+        A tuple (Q, C, policy) where policy is the greedy [BLACKJACK_SIZE, nA] policy table.
+    """
+    nS, nA = behavior.shape
+    Q = np.zeros([nS, nA]) if Q is None else Q
+    C = np.zeros([nS, nA]) if C is None else C
+    Q_flat, C_flat = Q.reshape(-1), C.reshape(-1)
+    inverse_behavior = np.divide(1.0, behavior, out=np.zeros_like(behavior), where=behavior > 0).reshape(-1)
+
+    for start in range(0, len(buffer), batch_size):
+        states, actions, rewards, mask = _padded_batch(buffer, start, min(start + batch_size, len(buffer)))
+        returns = batch_returns(rewards, discount_factor=discount_factor, mask=mask)
+        sa = states * nA + actions
+
+        W = np.ones(len(sa))
+        for t in range(sa.shape[1] - 1, -1, -1):
+            live = np.flatnonzero(mask[:, t] & (W > 0))
+            _merge(Q_flat, C_flat, sa[live, t], W[live], W[live] * returns[live, t])
+            # the target policy is greedy: the ratio is 0 if the action isn't the greedy one,
+            # else 1 / b(a|s)
+            greedy = np.argmax(Q[states[live, t]], axis=1) == actions[live, t]
+            W[live] *= np.where(greedy, inverse_behavior[sa[live, t]], 0.0)
+            if not W.any():
+                break
+
+    policy = np.eye(nA)[np.argmax(Q, axis=1)]
+    return Q, C, policy
+
+
+def value_views(Q, C, targets):
+    """
+    Dict views of V(s) = sum_a pi(a|s) Q(s, a) of the target policies, e.g. for
+    plotting.plot_value_function. Only states with importance weight are visited.
+    """
+    Q, C, targets = np.reshape(Q, np.shape(targets)), np.reshape(C, np.shape(targets)), np.asarray(targets)
+    return [BlackjackValueView((t * q).sum(axis=-1), (t * c).sum(axis=-1)) for q, c, t in zip(Q, C, targets)]
+
+
+if __name__ == "__main__":
+    env = BlackjackEnv()
+    random_policy = np.full([BLACKJACK_SIZE, 2], 0.5)
+
+    # one simulation budget for all policies below
+    buffer = EpisodeBuffer(obs_shape=(3,))
+    for i in range(500000):
+        generate_episode(env, False, make_table_policy(random_policy), buffer)
+
+    # sticking at 20 (the sample policy of mc_prediction), 18 and 17
+    targets = np.stack([policy_table(sample_policy)] +
+                       [policy_table(lambda obs, limit=limit: 0 if obs[0] >= limit else 1) for limit in (18, 17)])
+    Q, C, value = off_policy_mc_prediction(buffer, random_policy, targets)
+    print("Expected return of sticking at 20, 18, 17: {}".format(value))
+    plotting.plot_value_function(value_views(Q, C, targets)[0], title="Off-policy, stick at 20")
+
+    Q, C, policy = off_policy_mc_control(buffer, random_policy)
+    plotting.plot_value_function(value_views(Q[None], C[None], policy[None])[0], title="Optimal Value Function")
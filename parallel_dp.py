@@ -0,0 +1,191 @@
+import multiprocessing
+import multiprocessing.util
+import numpy as np
+import scipy.sparse
+
+from multiprocessing import shared_memory
+
+from mdp_model import compile_mdp
+
+"""
+Multi-core value iteration and policy evaluation.
+The compiled transition matrix and the value vector live in multiprocessing.shared_memory,
+and the state space is split into contiguous blocks that a process pool backs up in parallel.
+
+Two update schedules:
+    "jacobi": every block reads V from one buffer and writes the next sweep into another.
+        Workers synchronise once per sweep. Gives exactly the serial synchronous sweep.
+    "gauss-seidel": blocks read and write a single shared V, so later blocks see values
+        written earlier in the same sweep. Asynchronous, usually fewer sweeps.
+"""
+
+# Worker side state, filled in by _init_worker
+_worker = {}
+
+
+def _to_shared(arrays):
+    """
+    Copies a dict of numpy arrays into new shared memory blocks.
+    Returns the blocks (kept open by the parent) and the specs the workers need to attach.
+    """
+    blocks, specs = [], {}
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        blocks.append(shm)
+        specs[name] = (shm.name, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+
+def _close_worker():
+    # the arrays (and the cached CSR blocks) are views into the blocks and have to go first,
+    # close() raises BufferError while a view is still alive
+    blocks = _worker.get("shm", [])
+    _worker.clear()
+    for shm in blocks:
+        shm.close()
+
+
+def _init_worker(specs, nA):
+    _close_worker()
+    multiprocessing.util.Finalize(None, _close_worker, exitpriority=10)
+    _worker["shm"] = []
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker["shm"].append(shm)
+        _worker[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker["nA"] = nA
+    _worker["blocks"] = {}
+
+
+def _sweep_block(args):
+    """
+    Backs up the states lo .. hi-1: V_dst[s] = max_a R(s, a) + discount_factor * P(.|s, a) . V_src
+    With nA = 1 (a policy collapsed MDP) the max is the identity and this is policy evaluation.
+    Returns the largest absolute change in the block.
+    """
+    lo, hi, src, dst, discount_factor = args
+    nA = _worker["nA"]
+    # CSR row block of this worker, built once and reused on every sweep
+    if (lo, hi) not in _worker["blocks"]:
+        indptr = _worker["indptr"][lo * nA:hi * nA + 1]
+        start, stop = indptr[0], indptr[-1]
+        _worker["blocks"][(lo, hi)] = scipy.sparse.csr_matrix(
+            (_worker["data"][start:stop], _worker["indices"][start:stop], indptr - start),
+            shape=((hi - lo) * nA, _worker["V"].shape[1]))
+    P_block = _worker["blocks"][(lo, hi)]
+    V = _worker["V"]
+    q = (_worker["R"][lo * nA:hi * nA] + discount_factor * P_block.dot(V[src])).reshape(hi - lo, nA)
+    v_new = q.max(axis=1)
+    delta = np.max(np.abs(v_new - V[dst, lo:hi])) if hi > lo else 0.0
+    V[dst, lo:hi] = v_new
+    return delta
+
+
+def _solve(P, R, nA, theta, discount_factor, n_workers, mode, blocks_per_worker):
+    """
+    Runs parallel sweeps of V[s] = max_a R(s, a) + discount_factor * P(.|s, a) . V until
+    the largest change is below theta. P is a [S*nA, S] CSR matrix.
+    """
+    if mode not in ("jacobi", "gauss-seidel"):
+        raise ValueError("Unknown mode: {}".format(mode))
+    nS = P.shape[1]
+    n_workers = n_workers or multiprocessing.cpu_count()
+    # more blocks than workers balances the load, and in Gauss-Seidel mode spreads fresh values faster
+    n_blocks = min(nS, n_workers * blocks_per_worker)
+    bounds = np.linspace(0, nS, n_blocks + 1).astype(int)
+
+    # two value buffers for Jacobi (read one, write the other); Gauss-Seidel only uses V[0]
+    shm_blocks, specs = _to_shared({
+        "data": P.data, "indices": P.indices, "indptr": P.indptr,
+        "R": R, "V": np.zeros((2, nS))})
+    V = None
+    try:
+        V = np.ndarray((2, nS), dtype=float, buffer=shm_blocks[-1].buf)
+        with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(specs, nA)) as pool:
+            src = 0
+            while True:
+                dst = 1 - src if mode == "jacobi" else src
+                tasks = [(lo, hi, src, dst, discount_factor) for lo, hi in zip(bounds[:-1], bounds[1:])]
+                delta = max(pool.map(_sweep_block, tasks))
+                src = dst
+                if delta < theta:
+                    break
+        result = np.array(V[src])
+    finally:
+        # drop the view before close(), also when a sweep raised: with the view still alive
+        # close() raises BufferError and the blocks are never unlinked
+        del V
+        for shm in shm_blocks:
+            shm.close()
+            shm.unlink()
+    return result
+
+
+def parallel_value_iteration(env, theta=0.0001, discount_factor=1.0, n_workers=None,
+                             mode="jacobi", blocks_per_worker=4):
+    """
+    Value Iteration on a process pool. Same result as value_iteration.
+
+    Args:
+        env: OpenAI environment (or a CompiledMDP).
+        theta: Stopping threshold. If the value of all states changes less than theta
+            in one iteration we are done.
+        discount_factor: lambda time discount factor.
+        n_workers: Number of worker processes. Defaults to the number of cores.
+        mode: "jacobi" (synchronous sweeps) or "gauss-seidel" (asynchronous, in place).
+        blocks_per_worker: Number of state blocks per worker and sweep.
+
+    Returns:
+        A tuple (policy, V) of the optimal policy and the optimal value function.
+    """
+    mdp = compile_mdp(env)
+    V = _solve(mdp.P, mdp.R, mdp.nA, theta, discount_factor, n_workers, mode, blocks_per_worker)
+    policy = np.eye(mdp.nA)[mdp.q_values(V, discount_factor).argmax(axis=1)]
+    return policy, V
+
+
+def parallel_policy_eval(policy, env, discount_factor=1.0, theta=0.00001, n_workers=None,
+                         mode="jacobi", blocks_per_worker=4):
+    """
+    Policy Evaluation on a process pool. Same signature and result as policy_eval_pm.
+
+    Args:
+        policy: [S, A] shaped matrix representing the policy.
+        env: OpenAI env (or a CompiledMDP).
+        discount_factor: gamma discount factor.
+        theta: We stop evaluation once our value function change is less than theta for all states.
+        n_workers: Number of worker processes. Defaults to the number of cores.
+        mode: "jacobi" (synchronous sweeps) or "gauss-seidel" (asynchronous, in place).
+        blocks_per_worker: Number of state blocks per worker and sweep.
+
+    Returns:
+        Vector of length env.nS representing the value function.
+    """
+    P_pi, R_pi = compile_mdp(env).policy_model(policy)
+    # a policy collapsed MDP is just an MDP with a single action
+    return _solve(P_pi, R_pi, 1, theta, discount_factor, n_workers, mode, blocks_per_worker)
+
+
+# The checks only run as a script: the process pool may re-import this module in its workers.
+if __name__ == "__main__":
+    from mdp_generators import random_sparse_mdp
+    from policy_evaluation import policy_eval_pm
+    from value_iteration import value_iteration
+
+    mdp = random_sparse_mdp(2000, seed=0)
+
+    # Test: both schedules converge to the serial value iteration result
+    policy, v = value_iteration(mdp, theta=1e-10, discount_factor=0.9)
+    for mode in ("jacobi", "gauss-seidel"):
+        parallel_policy, parallel_v = parallel_value_iteration(mdp, theta=1e-10, discount_factor=0.9,
+                                                               n_workers=2, mode=mode)
+        np.testing.assert_allclose(parallel_v, v, atol=5e-8)
+
+    # Test: parallel policy evaluation matches policy_eval_pm
+    random_policy = np.ones([mdp.nS, mdp.nA]) / mdp.nA
+    v = policy_eval_pm(random_policy, mdp, discount_factor=0.9, theta=1e-10)
+    for mode in ("jacobi", "gauss-seidel"):
+        np.testing.assert_allclose(parallel_policy_eval(random_policy, mdp, discount_factor=0.9, theta=1e-10,
+                                                        n_workers=2, mode=mode), v, atol=5e-8)
@@ -1,5 +1,11 @@
 import numpy as np
+import time
+import scipy.sparse
+import scipy.sparse.linalg
 from gym.envs.denny.gridworld import GridworldEnv
+from mdp_model import compile_mdp, MemmapMDP
+from dp_instrumentation import SweepRecorder
+from mdp_generators import gridworld_mdp
 
 env = GridworldEnv()
 
@@ -8,7 +14,8 @@ Exercise from Denny Britz. Implementation differs but result ok
 https://github.com/dennybritz/reinforcement-learning/blob/master/DP/Policy%20Evaluation.ipynb 
 """
 
-def policy_eval_pm(policy, env, discount_factor=1.0, theta=0.00001):
+def policy_eval_pm(policy, env, discount_factor=1.0, theta=0.00001, V_init=None, max_sweeps=None,
+                   callback=None):
     """
     Evaluate a policy given an environment and a full description of the environment's dynamics.
 
@@ -16,43 +23,159 @@ def policy_eval_pm(policy, env, discount_factor=1.0, theta=0.00001):
         policy: [S, A] shaped matrix representing the policy.
         env: OpenAI env. env.P represents the transition probabilities of the environment.
             env.P[s][a] is a (prob, next_state, reward, done) tuple.
+            A MemmapMDP (see mdp_model.save_mdp) is streamed from disk instead.
         theta: We stop evaluation once our value function change is less than theta for all states.
         discount_factor: gamma discount factor.
+        V_init: (Optional) value function to start from, e.g. the previous estimate
+            when warm starting from policy iteration. Defaults to all zeros.
+        max_sweeps: (Optional) stop after this many sweeps even if delta >= theta.
+        callback: (Optional) called after every sweep, see dp_instrumentation.
 
     Returns:
         Vector of length env.nS representing the value function.
     """
-    # Start with a random (all 0) value function
-    V = np.zeros(env.nS)
+    # Flatten env.P once; every sweep is then a single sparse mat-vec
+    mdp = compile_mdp(env)
+    if isinstance(mdp, MemmapMDP):
+        # out-of-core model: stream the transitions every sweep, P_pi would not fit in memory
+        sweep = lambda V: np.sum(policy * mdp.q_values(V, discount_factor), axis=1)
+    else:
+        P_pi, R_pi = mdp.policy_model(policy)
+        sweep = lambda V: R_pi + discount_factor * P_pi.dot(V)
+
+    # Start with a random (all 0) value function unless we are warm started
+    V = np.zeros(env.nS) if V_init is None else np.array(V_init, dtype=float)
     k = 0
+    start = time.perf_counter()
     while True:
-        delta = 0.00
         # calculate the V for the next iteration:
-        for s, v in enumerate(env.P.values()):
-            v_s = 0.0
-            for a, t in enumerate(v.values()):
-                prob, next_state, reward, done = t[0]
+        v_new = sweep(V)
+        change = np.abs(v_new - V)
+        delta = np.max(change)
+        V = v_new
+        k+=1
 
-                v_s += policy[s][a] * (reward + discount_factor * (prob * V[next_state]))
+        if callback is not None:
+            callback(k, delta, np.linalg.norm(change), np.count_nonzero(change > theta),
+                     time.perf_counter() - start)
 
-            delta = max(delta, np.abs(v_s - V[s]))
-            V[s] = v_s
+        if delta < theta or (max_sweeps is not None and k >= max_sweeps):
+            break
 
-        #print("Iteration ", k, " with delta: ", delta)
-        #print(V)
-        k+=1
+    return np.array(V)
 
-        if delta < theta:
-            break
+def policy_eval_linear(policy, env, discount_factor=1.0, theta=0.00001, method="lu"):
+    """
+    Evaluate a policy exactly by solving the Bellman expectation equation
+    (I - discount_factor * P_pi) V = R_pi as a sparse linear system.
+    Same signature as policy_eval_pm so it can be passed as policy_eval_fn to policy iteration.
+
+    Args:
+        policy: [S, A] shaped matrix representing the policy.
+        env: OpenAI env. env.P represents the transition probabilities of the environment.
+            env.P[s][a] is a (prob, next_state, reward, done) tuple.
+        discount_factor: gamma discount factor.
+        theta: Absolute residual tolerance of the iterative solver. Ignored by "lu".
+        method: "lu" for a direct sparse LU solve or "gmres" for GMRES with a Jacobi
+            (diagonal) preconditioner.
+
+    Returns:
+        Vector of length env.nS representing the value function.
+    """
+    mdp = compile_mdp(env)
+    P_pi, R_pi = mdp.policy_model(policy)
+
+    # Terminal states are absorbing with zero reward, so pin V[s] = 0 there. Without this
+    # the system is singular for discount_factor = 1.0 (the self loops have eigenvalue 1).
+    live = scipy.sparse.diags((~mdp.terminal).astype(float))
+    A = (scipy.sparse.identity(env.nS) - discount_factor * live.dot(P_pi)).tocsc()
+    b = np.where(mdp.terminal, 0.0, R_pi)
+
+    if method == "lu":
+        V = scipy.sparse.linalg.splu(A).solve(b)
+    elif method == "gmres":
+        inv_diag = 1.0 / A.diagonal()
+        M = scipy.sparse.linalg.LinearOperator(A.shape, matvec=lambda x: inv_diag * x)
+        V, info = scipy.sparse.linalg.gmres(A, b, M=M, atol=theta, rtol=0.0)
+        if info != 0:
+            raise RuntimeError("GMRES did not converge (info={})".format(info))
+    else:
+        raise ValueError("Unknown method: {}".format(method))
 
     return np.array(V)
 
-random_policy = np.ones([env.nS, env.nA]) / env.nA
-v = policy_eval_pm(random_policy, env)
+def policy_eval_batch(policies, env, discount_factors, theta=0.00001, callback=None):
+    """
+    Evaluate a stack of policies for several discount factors at once. Every sweep is a
+    single sparse mat-mat product with the shared transition model instead of K x G
+    separate policy_eval_pm runs.
+
+    Args:
+        policies: [K, S, A] shaped array of K policies.
+        env: OpenAI env. env.P represents the transition probabilities of the environment.
+        discount_factors: Vector of G gamma discount factors.
+        theta: We stop evaluation once the value change is less than theta for all
+            states, policies and discount factors.
+        callback: (Optional) called after every sweep, see dp_instrumentation. A state
+            counts as changed if its value changed for any policy or discount factor.
+
+    Returns:
+        [K, G, S] shaped array, V[k, g] is the value function of policy k under discount_factors[g].
+    """
+    mdp = compile_mdp(env)
+    policies = np.asarray(policies, dtype=float)
+    gammas = np.asarray(discount_factors, dtype=float)
+    K, G = policies.shape[0], gammas.shape[0]
+
+    # expected immediate reward of every policy, [K, S]; the same for every gamma
+    R_pi = np.einsum("ksa,sa->ks", policies, mdp.R.reshape(env.nS, env.nA))
+
+    # V is kept as [S, K*G] so that one P.dot() backs up every (policy, gamma) column
+    V = np.zeros((env.nS, K * G))
+    k = 0
+    start = time.perf_counter()
+    while True:
+        PV = mdp.P.dot(V).reshape(env.nS, env.nA, K, G)
+        v_new = R_pi.T[:, :, None] + gammas * np.einsum("ksa,sakg->skg", policies, PV)
+        v_new = v_new.reshape(env.nS, K * G)
+        change = np.abs(v_new - V)
+        delta = np.max(change)
+        V = v_new
+        k += 1
+
+        if callback is not None:
+            callback(k, delta, np.linalg.norm(change), np.count_nonzero(change.max(axis=1) > theta),
+                     time.perf_counter() - start)
+
+        if delta < theta:
+            break
+
+    return V.reshape(env.nS, K, G).transpose(1, 2, 0)
 
+# The demo and checks only run as a script, not when the solvers are imported.
+if __name__ == "__main__":
+    random_policy = np.ones([env.nS, env.nA]) / env.nA
+    recorder = SweepRecorder()
+    v = policy_eval_pm(random_policy, env, callback=recorder)
+    print("Policy evaluation converged in {} sweeps".format(len(recorder)))
 
-# Test: Make sure the evaluated policy is what we expected
-expected_v = np.array([0, -14, -20, -22, -14, -18, -20, -20, -20, -20, -18, -14, -22, -20, -14, 0])
-np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
+    # Test: Make sure the evaluated policy is what we expected
+    expected_v = np.array([0, -14, -20, -22, -14, -18, -20, -20, -20, -20, -18, -14, -22, -20, -14, 0])
+    np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
 
+    # Test: the direct solvers agree with the iterative evaluation
+    np.testing.assert_array_almost_equal(policy_eval_linear(random_policy, env), expected_v, decimal=2)
+    np.testing.assert_array_almost_equal(policy_eval_linear(random_policy, env, method="gmres"), expected_v, decimal=2)
+    # theta is the GMRES tolerance on its own (no relative tolerance on top), so a tight theta
+    # gets GMRES to the LU solution. The 4x4 grid is too small to tell: GMRES solves it exactly.
+    big_grid = gridworld_mdp((10, 10))
+    big_random_policy = np.ones([big_grid.nS, big_grid.nA]) / big_grid.nA
+    np.testing.assert_allclose(policy_eval_linear(big_random_policy, big_grid, theta=1e-10, method="gmres"),
+                               policy_eval_linear(big_random_policy, big_grid), atol=1e-8)
 
+    # Test: batched evaluation matches evaluating each (policy, gamma) pair on its own
+    policies = np.stack([random_policy, np.eye(env.nA)[np.random.randint(env.nA, size=env.nS)]])
+    gammas = np.array([0.5, 0.9])
+    v_batch = policy_eval_batch(policies, env, gammas)
+    for k, g in np.ndindex(len(policies), len(gammas)):
+        np.testing.assert_array_almost_equal(v_batch[k, g], policy_eval_pm(policies[k], env, gammas[g]), decimal=2)
@@ -1,10 +1,12 @@
 import numpy as np
+import time
 from gym.envs.denny.gridworld import GridworldEnv
 from policy_evaluation import policy_eval_pm
+from mdp_model import CompiledMDP, compile_mdp
 
 env = GridworldEnv()
 
-def policy_improvement_pm(env, policy_eval_fn=policy_eval_pm, discount_factor=1.0):
+def policy_improvement_pm(env, policy_eval_fn=policy_eval_pm, discount_factor=1.0, callback=None):
     """
     Policy Improvement Algorithm. Iteratively evaluates and improves a policy
     until an optimal policy is found.
@@ -14,6 +16,9 @@ def policy_improvement_pm(env, policy_eval_fn=policy_eval_pm, discount_factor=1.
         policy_eval_fn: Policy Evaluation function that takes 3 arguments:
             policy, env, discount_factor.
         discount_factor: Lambda discount factor.
+        callback: (Optional) called after every improvement step, see dp_instrumentation.
+            The residual is the Bellman optimality residual of the evaluated V and
+            states_changed the number of states whose greedy action changed.
 
     Returns:
         A tuple (policy, V).
@@ -27,48 +32,38 @@ def policy_improvement_pm(env, policy_eval_fn=policy_eval_pm, discount_factor=1.
     # Start with a random policy
     policy = np.ones([env.nS, env.nA]) / env.nA
 
-    # Capture the Q values
-    Q = np.zeros([env.nS, env.nA])
+    # Compile env.P once for all the improvement steps
+    mdp = compile_mdp(env)
 
+    start = time.perf_counter()
     while True:
 
         iterations +=1
         # get the value function for this policy
-        print("Policy Eval {} - Started".format(iterations))
-        v = policy_eval_fn(policy, env)
-        print("Policy Eval - Done")
-        print (v)
+        v = policy_eval_fn(policy, env, discount_factor)
 
         # set a flag to determine stability of this policy
         optimal_policy_flag = True
 
-        # for each state estimate the action value and decide which action is best for this state:
-        for s, v_s in enumerate(v):
+        # estimate the action values of every state in one sparse mat-vec. In this case Q[nS, no_of_actions]
+        Q = mdp.q_values(v, discount_factor)
 
-            q = np.zeros(env.nA)
+        # Improve Policy for every state, every iteration
+        # for each state s, choose the highest q value. This is the greedy action to follow
+        best_action = np.argmax(Q, axis=1)
+        current_action = np.argmax(policy, axis=1)
+        policy = np.eye(env.nA)[best_action]
 
-            # calc the state,action values (q) for this state. In this case q[no_of_actions] or q[4]
-            for a, action_prob in enumerate(policy[s]):
-                # For each action, calculate the action-value q
-                for prob, next_state, reward, done in env.P[s][a]:
-                    q[a] = prob * (reward + discount_factor * v[next_state])
+        #Check stopping condition: if no improvements this iteration can stop
+        changed = np.count_nonzero(best_action != current_action)
+        if changed:
+            # policy is still being improved so don't stop yet
+            optimal_policy_flag = False
 
-            # Improve Policy for every state, every iteration
-            # for this state s, choose the highest q value. This is the greedy action to follow
-            best_action = np.argmax(q)
-            current_action = np.argmax(policy[s])
-            policy[s] = np.zeros(env.nA)
-            policy[s][best_action] = 1.0
-
-            # Print variables
-            Q[s] = q
-
-            #Check stopping condition: if no improvements this iteration can stop
-            if best_action != current_action:
-                # policy is still being improved so don't stop yet
-                optimal_policy_flag = False
-
-        print("Updated Policy this iteration: \n", policy)
+        if callback is not None:
+            residual = np.abs(Q.max(axis=1) - v)
+            callback(iterations, residual.max(), np.linalg.norm(residual), changed,
+                     time.perf_counter() - start)
 
         if optimal_policy_flag:
             print("Optimal Policy achieved in {} iterations".format(iterations))
@@ -76,26 +71,99 @@ def policy_improvement_pm(env, policy_eval_fn=policy_eval_pm, discount_factor=1.
 
     return policy, v, Q
 
-# Tests:
+def modified_policy_iteration(env, policy_eval_fn=policy_eval_pm, discount_factor=1.0, k=5, theta=0.00001,
+                              callback=None):
+    """
+    Modified Policy Iteration. Like policy_improvement_pm but every evaluation is warm
+    started from the previous value function and capped at k sweeps, and the improvement
+    step only updates what can have changed: the Q values are backed up again only for the
+    states with a successor whose value moved in the evaluation, and only the policy rows
+    whose greedy action changed are rewritten.
 
-policy, v , q = policy_improvement_pm(env)
-print("Policy Probability Distribution:")
-print(policy)
-print("")
+    Args:
+        env: The OpenAI envrionment.
+        policy_eval_fn: Policy Evaluation function that accepts the V_init and
+            max_sweeps keyword arguments, see policy_eval_pm.
+        discount_factor: gamma discount factor.
+        k: Maximum number of evaluation sweeps per improvement step.
+        theta: We stop once the Bellman optimality residual is less than theta for all states.
+        callback: (Optional) called after every improvement step, see policy_improvement_pm.
 
-print("Reshaped Grid Policy (0=up, 1=right, 2=down, 3=left):")
-print(np.reshape(np.argmax(policy, axis=1), env.shape))
-print("")
+    Returns:
+        A tuple (policy, V, Q) as in policy_improvement_pm.
+    """
+    mdp = compile_mdp(env)
+    # s' -> states that can reach it; a MemmapMDP has no index and backs up all states
+    predecessors = mdp.predecessors() if isinstance(mdp, CompiledMDP) else None
 
-print("Value Function:")
-print(v)
-print("")
+    policy = np.ones([env.nS, env.nA]) / env.nA
+    # greedy action per state, -1 until the first improvement step
+    greedy = np.full(env.nS, -1)
+    v = np.zeros(env.nS)
+    Q = mdp.q_values(v, discount_factor)
+    iterations = 0
+    start = time.perf_counter()
 
-print("Action Value Function:")
-print(q)
-print("")
+    while True:
+        iterations += 1
+        best_action = np.argmax(Q, axis=1)
+
+        # Only touch the rows of the policy whose greedy action changed
+        changed = np.flatnonzero(best_action != greedy)
+        policy[changed] = 0.0
+        policy[changed, best_action[changed]] = 1.0
+        greedy[changed] = best_action[changed]
+
+        # Bellman optimality residual: once small enough v is (close to) optimal and so is the policy
+        residual = np.abs(Q.max(axis=1) - v)
+        if callback is not None:
+            callback(iterations, residual.max(), np.linalg.norm(residual), len(changed),
+                     time.perf_counter() - start)
+        if residual.max() < theta:
+            break
 
-#Test the value function
-expected_v = np.array([ 0, -1, -2, -3, -1, -2, -3, -2, -2, -3, -2, -1, -3, -2, -1,  0])
-np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
+        # partial evaluation: k sweeps starting from the previous value function
+        v_new = policy_eval_fn(policy, env, discount_factor, theta, V_init=v, max_sweeps=k)
+
+        # new backups only for the states with a successor whose value moved. Finding them
+        # costs about as much as a full backup when most states qualify, so then back up all.
+        stale = None
+        if predecessors is not None:
+            stale = np.unique(predecessors[np.flatnonzero(v_new != v)].indices)
+        if stale is None or len(stale) > env.nS // 2:
+            Q = mdp.q_values(v_new, discount_factor)
+        elif len(stale):
+            Q[stale] = mdp.q_values(v_new, discount_factor, stale)
+        v = v_new
+
+    return policy, v, Q
 
+# The demo and checks only run as a script, not when the solvers are imported.
+if __name__ == "__main__":
+    # Tests:
+    policy, v , q = policy_improvement_pm(env)
+    print("Policy Probability Distribution:")
+    print(policy)
+    print("")
+
+    print("Reshaped Grid Policy (0=up, 1=right, 2=down, 3=left):")
+    print(np.reshape(np.argmax(policy, axis=1), env.shape))
+    print("")
+
+    print("Value Function:")
+    print(v)
+    print("")
+
+    print("Action Value Function:")
+    print(q)
+    print("")
+
+    #Test the value function
+    expected_v = np.array([ 0, -1, -2, -3, -1, -2, -3, -2, -2, -3, -2, -1, -3, -2, -1,  0])
+    np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
+
+    #Test modified policy iteration reaches the same value function
+    policy, v, q = modified_policy_iteration(env)
+    np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
+    # the partial backups leave Q equal to a full backup of the final value function
+    np.testing.assert_array_almost_equal(q, compile_mdp(env).q_values(v))
@@ -0,0 +1,137 @@
+import numpy as np
+
+from scipy.signal import lfilter
+
+"""
+Discounted returns of trajectories, without Python loops over the timesteps.
+G_t = r_t + discount_factor * G_t+1 is a first order linear recursion running backwards in
+time, so it is a linear filter over the reversed rewards (scipy.signal.lfilter) with
+b = [1], a = [1, -discount_factor]. n-step and lambda-returns are built the same way.
+"""
+
+
+def _reverse_filter(b, a, x, axis=-1):
+    """
+    lfilter over x reversed along axis, so the filter runs from the end of the episode to the start.
+    """
+    x = np.flip(np.asarray(x, dtype=np.float64), axis)
+    return np.flip(lfilter(b, a, x, axis=axis), axis)
+
+
+def discounted_returns(rewards, discount_factor=1.0):
+    """
+    Return G_t of every timestep of a single episode.
+
+    Args:
+        rewards: Rewards r_0 .. r_T-1 of the episode.
+        discount_factor: Gamma discount factor.
+
+    Returns:
+        An array with G_t for every timestep.
+    """
+    return _reverse_filter([1.0], [1.0, -discount_factor], rewards)
+
+
+def batch_returns(rewards, dones=None, discount_factor=1.0, mask=None):
+    """
+    Returns G_t of a padded batch of trajectories.
+
+    Args:
+        rewards: [N, T] rewards, one trajectory per row.
+        dones: (Optional) [N, T] bool, True at the last step of an episode. A row may then hold
+            several consecutive episodes (e.g. an auto-resetting env) and the return restarts
+            after every done. Without dones every row is a single episode.
+        discount_factor: Gamma discount factor.
+        mask: (Optional) [N, T] bool, True for the real (unpadded) steps. Padding rewards are
+            treated as 0 and get a return of 0.
+
+    Returns:
+        A [N, T] array of returns.
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if mask is not None:
+        rewards = np.where(mask, rewards, 0.0)
+
+    if dones is None:
+        returns = _reverse_filter([1.0], [1.0, -discount_factor], rewards, axis=1)
+    else:
+        # the discount changes at every done, which a fixed filter can't do: scan backwards over
+        # the timesteps instead, all rows at once
+        carry = discount_factor * ~np.asarray(dones, dtype=bool)
+        returns = np.zeros(rewards.shape)
+        G = np.zeros(len(rewards))
+        for t in range(rewards.shape[1] - 1, -1, -1):
+            G = rewards[:, t] + carry[:, t] * G
+            returns[:, t] = G
+
+    if mask is not None:
+        returns[~mask] = 0.0
+    return returns
+
+
+def concatenated_returns(rewards, lengths, discount_factor=1.0):
+    """
+    Returns G_t of consecutive episodes stored back to back (e.g. EpisodeBuffer.episodes()).
+
+    Args:
+        rewards: Rewards of all steps of the episodes, concatenated.
+        lengths: Number of steps of every episode.
+        discount_factor: Gamma discount factor.
+
+    Returns:
+        An array with G_t for every step, in the order of rewards.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return np.zeros(0)
+    # scatter into a zero padded [episodes, max length] batch, filter the rows and gather back
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    padded = np.zeros(mask.shape)
+    padded[mask] = rewards
+    return batch_returns(padded, discount_factor=discount_factor)[mask]
+
+
+def n_step_returns(rewards, values=None, n=1, discount_factor=1.0):
+    """
+    n-step returns of a single episode:
+    G_t:t+n = r_t + ... + discount_factor^(n-1) * r_t+n-1 + discount_factor^n * V(S_t+n).
+    Near the end of the episode (t + n >= T) this is the full return G_t.
+
+    Args:
+        rewards: Rewards r_0 .. r_T-1 of the episode.
+        values: (Optional) V(S_t) of the states S_0 .. S_T-1 of the episode, used for the
+            bootstrap. None means no bootstrap (V = 0).
+        n: Number of steps.
+        discount_factor: Gamma discount factor.
+
+    Returns:
+        An array with G_t:t+n for every timestep.
+    """
+    # FIR filter with taps 1, gamma, ..., gamma^(n-1) over the reversed rewards
+    taps = discount_factor ** np.arange(n)
+    returns = _reverse_filter(taps, [1.0], rewards)
+    if values is not None and n < len(returns):
+        returns[:-n] += discount_factor ** n * np.asarray(values, dtype=np.float64)[n:]
+    return returns
+
+
+def lambda_returns(rewards, values, lam, discount_factor=1.0):
+    """
+    lambda-returns of a single episode, from the recursive form
+    G_t = r_t + discount_factor * ((1 - lam) * V(S_t+1) + lam * G_t+1), with G_T = 0.
+    lam = 1 gives the Monte Carlo return, lam = 0 the one step TD target.
+
+    Args:
+        rewards: Rewards r_0 .. r_T-1 of the episode.
+        values: V(S_t) of the states S_0 .. S_T-1 of the episode (the terminal state has value 0).
+        lam: Lambda in [0, 1].
+        discount_factor: Gamma discount factor.
+
+    Returns:
+        An array with the lambda-return of every timestep.
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    next_values = np.append(np.asarray(values, dtype=np.float64)[1:], 0.0)
+    # same recursion as discounted_returns, with the bootstrapped part folded into the input
+    inputs = rewards + discount_factor * (1 - lam) * next_values
+    return _reverse_filter([1.0], [1.0, -discount_factor * lam], inputs)
@@ -4,13 +4,17 @@ import matplotlib
 import numpy as np
 import pandas as pd
 import sys
+import time
 
 if "../" not in sys.path:
   sys.path.append("../")
 
-from collections import defaultdict
 from gym.envs.denny.windy_gridworld import WindyGridworldEnv
 from gym.envs.denny import plotting
+from exploration import EpsilonGreedySampler
+from training_telemetry import TrainingTelemetry
+from value_tables import QTableView, make_q_table
+from vector_env import TabularVectorEnv
 
 matplotlib.style.use('ggplot')
 
@@ -20,7 +24,7 @@ def make_epsilon_greedy_policy(Q, epsilon, nA):
     Creates an epsilon-greedy policy based on a given Q-function and epsilon.
 
     Args:
-        Q: A dictionary that maps from state -> action-values.
+        Q: A dictionary that maps from state -> action-values, or a dense [nS, nA] table.
             Each value is a numpy array of length nA (see below)
         epsilon: The probability to select a random action . float between 0 and 1.
         nA: Number of actions in the environment.
@@ -40,7 +44,8 @@ def make_epsilon_greedy_policy(Q, epsilon, nA):
     return policy_fn
 
 
-def sarsa(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1):
+def sarsa(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1, dtype=np.float64, callback=None,
+          telemetry=None):
     """
     SARSA algorithm: On-policy TD control. Finds the optimal epsilon-greedy policy.
 
@@ -50,49 +55,53 @@ def sarsa(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1):
         discount_factor: Lambda time discount factor.
         alpha: TD learning rate.
         epsilon: Chance the sample a random action. Float betwen 0 and 1.
+        dtype: dtype of the Q table, e.g. np.float32 to halve its size.
+        callback: (Optional) called as callback(i_episode, stats) after every episode.
+            Training stops early if it returns True (the remaining stats stay 0).
+        telemetry: (Optional) training_telemetry.TrainingTelemetry every episode is recorded to.
+            By default a progress line is printed every 10 seconds.
 
     Returns:
         A tuple (Q, stats).
-        Q is the optimal action-value function, a dictionary mapping state -> action values.
+        Q is the optimal action-value function, a dictionary view mapping state -> action values
+        of the dense table Q.table (see value_tables.QTableView).
         stats is an EpisodeStats object with two numpy arrays for episode_lengths and episode_rewards.
     """
 
     # The final action-value function.
-    # A nested dictionary that maps state -> (action -> action-value).
-    Q = defaultdict(lambda: np.zeros(env.action_space.n))
+    # A dense [nS, nA] table: Q[state, action] -> action-value.
+    Q = make_q_table(env, dtype)
 
     # Keeps track of useful statistics
     stats = plotting.EpisodeStats(
         episode_lengths=np.zeros(num_episodes),
         episode_rewards=np.zeros(num_episodes))
 
-    # The policy we're following
-    policy = make_epsilon_greedy_policy(Q, epsilon, env.action_space.n)
+    # The policy we're following: samples epsilon-greedy actions from Q[state] directly
+    # (same distribution as make_epsilon_greedy_policy, without a probability vector per step)
+    policy = EpsilonGreedySampler(epsilon, env.action_space.n)
 
-    for i_episode in range(num_episodes):
-        # Print out which episode we're on, useful for debugging.
-        if (i_episode + 1) % 100 == 0:
-            print("\rEpisode {}/{}.".format(i_episode + 1, num_episodes), end="")
-            sys.stdout.flush()
+    # Progress and metrics, written out in batches (see training_telemetry)
+    own_telemetry = telemetry is None
+    if own_telemetry:
+        telemetry = TrainingTelemetry(print_progress=True, total_episodes=num_episodes)
 
+    for i_episode in range(num_episodes):
         # generate episode
         state = env.reset()
-        # get the policy for this state using the latest Q values and epsilon.
-        action_prob = policy(state)
-        # now choose an action using the policy distribution vs uniform distribution
-        action = np.random.choice(len(action_prob), p=action_prob) # choice applies the distribution passed in
+        # choose an action for this state using the latest Q values and epsilon.
+        action = policy.sample(Q[state])
 
         # now take steps until the end of episode is reached and update Q[state][action]
         while True:
             # Take a step
             next_state, reward, done, prob = env.step(action)
 
-            # Get policy for next_state using latest Q-values; choose an action using the epsilon-greedy distri., etc.
-            action_prob = policy(next_state)
-            next_action = np.random.choice(len(action_prob), p=action_prob)
+            # Choose the next action using the latest Q-values and the epsilon-greedy distribution
+            next_action = policy.sample(Q[next_state])
 
             # Update Q
-            Q[state][action] += alpha * ( (reward + discount_factor*Q[next_state][next_action]) - Q[state][action])
+            Q[state, action] += alpha * ( (reward + discount_factor*Q[next_state, next_action]) - Q[state, action])
 
             # reset vars
             state = next_state
@@ -104,10 +113,266 @@ def sarsa(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1):
             if done == True:
                 break
 
-    return Q, stats
+        telemetry.record(i_episode, stats.episode_lengths[i_episode], stats.episode_rewards[i_episode])
+        if callback is not None and callback(i_episode, stats):
+            break
+
+    if own_telemetry:
+        telemetry.close()
+    else:
+        telemetry.flush()
+
+    return QTableView(Q), stats
+
+
+class SparseTraces():
+    """
+    Eligibility traces e(s, a) of a dense [nS, nA] Q table kept as a sparse active set:
+    parallel arrays of the flat (state, action) indices and trace values of the active
+    entries, plus a dense position map for O(1) lookups. Decaying, pruning and applying
+    the traces cost O(active traces) instead of O(nS * nA).
+
+    Args:
+        size: nS * nA.
+        threshold: Traces that decay below this are dropped.
+    """
+
+    def __init__(self, size, threshold=1e-4):
+        self.threshold = threshold
+        self.indices = np.zeros(64, dtype=np.int64)
+        self.values = np.zeros(64)
+        self.n = 0
+        self._position = np.full(size, -1, dtype=np.int64)
+
+    def visit(self, sa, replacing=False):
+        """
+        Bumps the trace of the flat index sa: e = 1 (replacing) or e += 1 (accumulating).
+        """
+        p = self._position[sa]
+        if p < 0:
+            if self.n == len(self.indices):
+                self.indices = np.resize(self.indices, 2 * self.n)
+                self.values = np.resize(self.values, 2 * self.n)
+            p = self.n
+            self._position[sa] = p
+            self.indices[p] = sa
+            self.values[p] = 0.0
+            self.n += 1
+        self.values[p] = 1.0 if replacing else self.values[p] + 1.0
+
+    def apply(self, Q_flat, step):
+        """
+        Q(s, a) += step * e(s, a) for the active traces.
+        """
+        Q_flat[self.indices[:self.n]] += step * self.values[:self.n]
+
+    def decay(self, factor):
+        """
+        Multiplies the traces by factor and drops the ones below the threshold.
+        """
+        values = self.values[:self.n]
+        values *= factor
+        keep = values >= self.threshold
+        if not keep.all():
+            self._position[self.indices[:self.n][~keep]] = -1
+            kept = np.count_nonzero(keep)
+            self.indices[:kept] = self.indices[:self.n][keep]
+            self.values[:kept] = values[keep]
+            self.n = kept
+            self._position[self.indices[:kept]] = np.arange(kept)
+
+    def clear(self):
+        self._position[self.indices[:self.n]] = -1
+        self.n = 0
+
+
+def sarsa_lambda(env, num_episodes, discount_factor=1.0, alpha=0.5, epsilon=0.1, lambda_=0.9, method="sarsa",
+                 trace="replacing", trace_threshold=1e-4, dtype=np.float64, telemetry=None):
+    """
+    SARSA(lambda) / Watkins Q(lambda): TD control with eligibility traces, so every TD error
+    updates all recently visited (state, action) pairs and rewards propagate back in far
+    fewer episodes than one-step SARSA. The traces are a sparse active set (SparseTraces).
+
+    Args:
+        env: OpenAI environment.
+        num_episodes: Number of episodes to run for.
+        discount_factor: Lambda time discount factor.
+        alpha: TD learning rate.
+        epsilon: Chance the sample a random action. Float betwen 0 and 1.
+        lambda_: Trace decay parameter, between 0 (one-step TD) and 1.
+        method: "sarsa" for on-policy SARSA(lambda), "watkins" for off-policy Watkins Q(lambda)
+            (greedy targets, traces are cut after an exploratory action).
+        trace: "replacing" or "accumulating" traces.
+        trace_threshold: Traces below this are dropped from the active set.
+        dtype: dtype of the Q table.
+        telemetry: (Optional) training_telemetry.TrainingTelemetry every episode is recorded to.
+            By default a progress line is printed every 10 seconds.
+
+    Returns:
+        A tuple (Q, stats) as sarsa().
+    """
+    if method not in ("sarsa", "watkins"):
+        raise ValueError("method must be 'sarsa' or 'watkins'")
+    if trace not in ("replacing", "accumulating"):
+        raise ValueError("trace must be 'replacing' or 'accumulating'")
+    replacing = trace == "replacing"
+
+    Q = make_q_table(env, dtype)
+    Q_flat = Q.reshape(-1)
+    nA = Q.shape[1]
+
+    stats = plotting.EpisodeStats(
+        episode_lengths=np.zeros(num_episodes),
+        episode_rewards=np.zeros(num_episodes))
+
+    policy = EpsilonGreedySampler(epsilon, env.action_space.n)
+    traces = SparseTraces(Q.size, trace_threshold)
+
+    # Progress and metrics, written out in batches (see training_telemetry)
+    own_telemetry = telemetry is None
+    if own_telemetry:
+        telemetry = TrainingTelemetry(print_progress=True, total_episodes=num_episodes)
+
+    for i_episode in range(num_episodes):
+        state = env.reset()
+        action = policy.sample(Q[state])
+        traces.clear()
+
+        while True:
+            next_state, reward, done, prob = env.step(action)
+            next_action = policy.sample(Q[next_state])
+
+            if method == "sarsa":
+                target = reward + discount_factor * Q[next_state, next_action]
+            else:
+                best_next = Q[next_state].max()
+                target = reward + discount_factor * best_next
+            delta = target - Q[state, action]
+            # before the update below, which can change which actions are greedy
+            greedy = method == "sarsa" or Q[next_state, next_action] == best_next
+
+            traces.visit(state * nA + action, replacing)
+            traces.apply(Q_flat, alpha * delta)
+            if not greedy:
+                # exploratory action: the greedy target policy would not have taken it
+                traces.clear()
+            else:
+                traces.decay(discount_factor * lambda_)
+
+            state = next_state
+            action = next_action
+            stats.episode_lengths[i_episode] += 1
+            stats.episode_rewards[i_episode] += reward
+
+            if done == True:
+                break
+
+        telemetry.record(i_episode, stats.episode_lengths[i_episode], stats.episode_rewards[i_episode])
+
+    if own_telemetry:
+        telemetry.close()
+    else:
+        telemetry.flush()
+
+    return QTableView(Q), stats
+
+
+def sarsa_vectorized(env, num_episodes, num_envs=64, discount_factor=1.0, alpha=0.5, epsilon=0.1, dtype=np.float64,
+                     seed=None, telemetry=None):
+    """
+    SARSA on num_envs copies of the environment stepped in lockstep (vector_env.TabularVectorEnv).
+    Every step picks the N actions with one vectorized epsilon-greedy draw and applies the
+    N TD updates to the shared Q table with one np.add.at. Finished episodes are reset
+    automatically. Copies that update the same (state, action) in the same step share one
+    update with their mean TD error (adding them up would overshoot by the number of copies).
+
+    Args:
+        env: OpenAI environment with nS, nA and P.
+        num_episodes: Number of episodes to run for, over all copies.
+        num_envs: Number of copies N stepped together.
+        discount_factor: Lambda time discount factor.
+        alpha: TD learning rate.
+        epsilon: Chance the sample a random action. Float betwen 0 and 1.
+        dtype: dtype of the Q table.
+        seed: Seed for the environment copies.
+        telemetry: (Optional) training_telemetry.TrainingTelemetry every episode is recorded to.
+            By default a progress line is printed every 10 seconds.
+
+    Returns:
+        A tuple (Q, stats) as sarsa(). stats has the episodes in the order they finished.
+    """
+    Q = make_q_table(env, dtype)
+
+    stats = plotting.EpisodeStats(
+        episode_lengths=np.zeros(num_episodes),
+        episode_rewards=np.zeros(num_episodes))
+
+    venv = TabularVectorEnv(env, num_envs, seed)
+    policy = EpsilonGreedySampler(epsilon, env.action_space.n)
+    # length and reward of the running episode of every copy
+    lengths = np.zeros(num_envs)
+    rewards_sum = np.zeros(num_envs)
+    # the copies run their episodes side by side, so each one is timed from its own start
+    started = np.full(num_envs, time.perf_counter())
+    episodes_done = 0
+
+    # Progress and metrics, written out in batches (see training_telemetry)
+    own_telemetry = telemetry is None
+    if own_telemetry:
+        telemetry = TrainingTelemetry(print_progress=True, total_episodes=num_episodes)
+
+    states = venv.reset()
+    actions = policy.sample_batch(Q[states])
+    while episodes_done < num_episodes:
+        next_states, rewards, dones, observations = venv.step(actions)
+        next_actions = policy.sample_batch(Q[next_states])
+
+        # TD updates of all copies at once; no bootstrap from the terminal states
+        targets = rewards + discount_factor * np.where(dones, 0.0, Q[next_states, next_actions])
+        td_errors = targets - Q[states, actions]
+        _, duplicates, counts = np.unique(states * Q.shape[1] + actions, return_inverse=True, return_counts=True)
+        np.add.at(Q, (states, actions), alpha * td_errors / counts[duplicates])
+
+        lengths += 1
+        rewards_sum += rewards
+        if dones.any():
+            finished = np.flatnonzero(dones)[:num_episodes - episodes_done]
+            stats.episode_lengths[episodes_done:episodes_done + len(finished)] = lengths[finished]
+            stats.episode_rewards[episodes_done:episodes_done + len(finished)] = rewards_sum[finished]
+            now = time.perf_counter()
+            for i_episode, copy in enumerate(finished, episodes_done):
+                telemetry.record(i_episode, stats.episode_lengths[i_episode], stats.episode_rewards[i_episode],
+                                 now - started[copy])
+            episodes_done += len(finished)
+            lengths[dones] = 0
+            rewards_sum[dones] = 0
+            started[dones] = now
+            # the reset copies start over with an action for their new state
+            next_actions[dones] = policy.sample_batch(Q[observations[dones]])
+
+        states, actions = observations, next_actions
+
+    if own_telemetry:
+        telemetry.close()
+    else:
+        telemetry.flush()
+
+    return QTableView(Q), stats
+
+# The demo and checks only run as a script: the process pool of sweep.py imports this module in its workers.
+if __name__ == "__main__":
+    # Test: with only greedy actions (epsilon = 0) Watkins Q(lambda) never cuts its traces and its
+    # greedy target is the SARSA target, so both learn exactly the same Q from the same random draws
+    np.random.seed(0)
+    Q_sarsa, _ = sarsa_lambda(WindyGridworldEnv(), 10, epsilon=0.0, telemetry=TrainingTelemetry())
+    np.random.seed(0)
+    Q_watkins, _ = sarsa_lambda(WindyGridworldEnv(), 10, epsilon=0.0, method="watkins", telemetry=TrainingTelemetry())
+    np.testing.assert_array_equal(Q_watkins.table, Q_sarsa.table)
 
-env = WindyGridworldEnv()
-Q, stats = sarsa(env, 300)
-print(Q)
+    env = WindyGridworldEnv()
+    Q, stats = sarsa(env, 300)
+    # Q, stats = sarsa_vectorized(env, 300, num_envs=64)
+    # Q, stats = sarsa_lambda(env, 300, lambda_=0.9)
+    print(Q)
 
-plotting.plot_episode_stats(stats)
\ No newline at end of file
+    plotting.plot_episode_stats(stats)
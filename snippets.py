@@ -19,6 +19,11 @@ state = (12, 4, False)
 first_occurence_idx = next(i for i ,x in enumerate(episode) if x[0] == state)
 # Sum up all rewards since the first occurance
 G = sum([x[2 ] *( discount_factor **i) for i ,x in enumerate(episode[first_occurence_idx:])])
+# Same thing with returns.py, which gives G_t for every timestep at once
+from returns import discounted_returns
+G_vectorized = discounted_returns([x[2] for x in episode], discount_factor)[first_occurence_idx]
+# (12, 4) is first seen at t=0: G = 0 + -1 + 0 + -1, as in exercises.expected_return[0]
+assert G == G_vectorized == -2.0
 
 
 
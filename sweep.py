@@ -0,0 +1,201 @@
+import itertools
+import json
+import multiprocessing
+import time
+
+import numpy as np
+
+from scipy import stats as scipy_stats
+
+"""
+Hyperparameter and seed sweeps for the TD learners.
+Every (parameter combination, seed) is one run on a process pool. The EpisodeStats of all
+runs go into one columnar results table (an .npz file with one array per column, one row
+per episode) and are summarized per parameter combination as the mean final reward with a
+confidence interval over the seeds.
+Runs that are clearly losing can be stopped early with the median stopping rule: at every
+check a run stops if its recent mean reward is below the median of what the other runs
+had at the same episode.
+"""
+
+
+def _run_sarsa(params, num_episodes, callback):
+    # imported here so the parent process only pays for the learner it sweeps
+    from gym.envs.denny.windy_gridworld import WindyGridworldEnv
+    from sarsa import sarsa
+    from training_telemetry import TrainingTelemetry
+    # no progress lines: the output of the pool workers would interleave
+    Q, stats = sarsa(WindyGridworldEnv(), num_episodes, callback=callback,
+                     telemetry=TrainingTelemetry(print_progress=False), **params)
+    return stats
+
+
+def _run_q_learning(params, num_episodes, callback):
+    # function_approximation fits its MountainCar featurizer on import, once per worker
+    import function_approximation
+    from training_telemetry import TrainingTelemetry
+    estimator = function_approximation.Estimator()
+    return function_approximation.q_learning(function_approximation.env, estimator, num_episodes,
+                                             callback=callback, telemetry=TrainingTelemetry(print_progress=False),
+                                             **params)
+
+
+# learner name -> function(params, num_episodes, callback) returning EpisodeStats
+LEARNERS = {
+    "sarsa": _run_sarsa,
+    "q_learning": _run_q_learning,
+}
+
+
+def _median_stopping(progress, check_every, window, grace_episodes, min_runs):
+    """
+    Episode callback for the learners implementing the median stopping rule. progress maps
+    every check episode to a list shared by all runs (multiprocessing.Manager) of the mean
+    rewards reported there, so a check only fetches the reports of its own episode.
+    """
+    def callback(i_episode, stats):
+        episode = i_episode + 1
+        if episode < grace_episodes or episode % check_every != 0:
+            return False
+        mean_reward = float(np.mean(stats.episode_rewards[episode - window:episode]))
+        reports = progress[episode]
+        others = reports[:]
+        reports.append(mean_reward)
+        return len(others) >= min_runs and mean_reward < np.median(others)
+    return callback
+
+
+def _sweep_worker(args):
+    learner, run, params, seed, num_episodes, progress, early_stopping = args
+    np.random.seed(seed)
+    callback = _median_stopping(progress, **early_stopping) if early_stopping else None
+    start = time.perf_counter()
+    stats = LEARNERS[learner](params, num_episodes, callback)
+    wall_time = time.perf_counter() - start
+    # episodes after an early stop have length 0
+    episodes_run = int(np.count_nonzero(stats.episode_lengths))
+    return run, np.asarray(stats.episode_lengths), np.asarray(stats.episode_rewards), episodes_run, wall_time
+
+
+def sweep(learner, grid, num_seeds=5, num_episodes=300, n_workers=None, seed=0, early_stopping=True,
+          check_every=25, window=25, grace_episodes=50, min_runs=3, confidence=0.95,
+          out_path="sweep_results.npz"):
+    """
+    Runs a learner for every combination of the parameter grid and num_seeds seeds.
+
+    Args:
+        learner: Name of the learner in LEARNERS, "sarsa" or "q_learning".
+        grid: Dictionary parameter name -> list of values, e.g.
+            {"alpha": [0.1, 0.5], "epsilon": [0.05, 0.1]} for sarsa or
+            {"epsilon": [0.0, 0.1], "epsilon_decay": [1.0, 0.99]} for q_learning.
+        num_seeds: Number of seeds per parameter combination.
+        num_episodes: Number of episodes per run.
+        n_workers: Number of worker processes. Defaults to the number of cores.
+        seed: Root seed; the run seeds are drawn from np.random.SeedSequence(seed).
+        early_stopping: Stop runs with the median stopping rule (see _median_stopping).
+        check_every: Episodes between stopping checks.
+        window: Number of recent episodes averaged for the stopping checks and the summary.
+        grace_episodes: No run is stopped before this episode.
+        min_runs: Number of reports at an episode needed before a run can be stopped there.
+        confidence: Confidence level of the intervals in the summary.
+        out_path: .npz file for the results table, or None to skip writing.
+
+    Returns:
+        A tuple (table, summary). table is a dictionary of column name -> array with one row
+        per run and episode (columns run, seed, episode, episode_length, episode_reward and
+        one column per parameter). summary has one dictionary per parameter combination,
+        best mean final reward first. The final reward of a run that was stopped early is
+        the one it had when it was stopped.
+    """
+    names = sorted(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(num_seeds)]
+    runs = [(params, s) for params in combinations for s in seeds]
+    settings = dict(check_every=check_every, window=window, grace_episodes=grace_episodes,
+                    min_runs=min_runs) if early_stopping else None
+
+    n_workers = n_workers or multiprocessing.cpu_count()
+    with multiprocessing.Manager() as manager, multiprocessing.Pool(n_workers) as pool:
+        # one shared list of reports per episode with a stopping check
+        progress = {episode: manager.list() for episode in range(check_every, num_episodes + 1, check_every)
+                    if episode >= grace_episodes} if early_stopping else None
+        results = pool.map(_sweep_worker, [(learner, run, params, s, num_episodes, progress, settings)
+                                           for run, (params, s) in enumerate(runs)])
+
+    # columnar table: every run contributes the episodes it actually ran
+    results.sort(key=lambda result: result[0])
+    episodes_run = np.array([result[3] for result in results])
+    run_column = np.repeat(np.arange(len(runs)), episodes_run)
+    table = {
+        "run": run_column,
+        "seed": np.array([s for params, s in runs])[run_column],
+        "episode": np.concatenate([np.arange(n) for n in episodes_run]),
+        "episode_length": np.concatenate([lengths[:n] for _, lengths, _, n, _ in results]),
+        "episode_reward": np.concatenate([rewards[:n] for _, _, rewards, n, _ in results]),
+    }
+    for name in names:
+        table["param_" + name] = np.array([params[name] for params, s in runs])[run_column]
+    if out_path is not None:
+        np.savez(out_path, **table)
+
+    # summary: final reward (mean of the last window episodes run) over the seeds
+    summary = []
+    for i, params in enumerate(combinations):
+        members = results[i * num_seeds:(i + 1) * num_seeds]
+        final = np.array([rewards[max(n - window, 0):n].mean() if n else np.nan for _, _, rewards, n, _ in members])
+        mean = float(np.nanmean(final))
+        half_width = float(scipy_stats.t.ppf(0.5 + confidence / 2, num_seeds - 1) *
+                           np.nanstd(final, ddof=1) / np.sqrt(num_seeds)) if num_seeds > 1 else float("nan")
+        summary.append(dict(params, final_reward_mean=mean, final_reward_ci=half_width,
+                            stopped_early=int(sum(n < num_episodes for _, _, _, n, _ in members)),
+                            episodes_run=int(sum(n for _, _, _, n, _ in members)),
+                            wall_time_s=float(sum(t for _, _, _, _, t in members))))
+    summary.sort(key=lambda row: -row["final_reward_mean"])
+    for row in summary:
+        print("{}: {:.2f} +- {:.2f} ({} of {} stopped early)".format(
+            json.dumps({name: row[name] for name in names}), row["final_reward_mean"], row["final_reward_ci"],
+            row["stopped_early"], num_seeds))
+    return table, summary
+
+
+# The sweep only runs as a script: the process pool re-imports this module in its workers.
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from collections import namedtuple
+
+    # Test: the median stopping rule stops a run below the median of the earlier reports at
+    # the same episode, only at check episodes after the grace period and with enough reports
+    Stats = namedtuple("Stats", ["episode_rewards"])
+    progress = {50: [-10.0, -20.0, -30.0], 75: [-10.0]}
+    callback = _median_stopping(progress, check_every=25, window=25, grace_episodes=50, min_runs=3)
+    assert not callback(24, Stats(np.full(100, -99.0)))   # before the grace period
+    assert not callback(59, Stats(np.full(100, -99.0)))   # not a check episode
+    assert callback(49, Stats(np.full(100, -25.0)))       # -25 < median -20
+    assert not callback(49, Stats(np.full(100, -15.0)))   # -15 > median of the 4 reports, -22.5
+    assert not callback(74, Stats(np.full(100, -99.0)))   # only 1 report at episode 75
+    assert progress[50] == [-10.0, -20.0, -30.0, -25.0, -15.0]
+
+    # Test: a small sweep writes one table row per episode run, and runs only stop early at a
+    # check episode. A high epsilon does so badly on the windy gridworld that some of its runs stop.
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, "sweep.npz")
+        table, summary = sweep("sarsa", {"epsilon": [0.1, 0.9]}, num_seeds=3, num_episodes=100, n_workers=2,
+                               check_every=25, window=25, grace_episodes=50, min_runs=2, out_path=out_path)
+        saved = np.load(out_path)
+        assert sorted(saved.files) == sorted(table)
+        for name in table:
+            np.testing.assert_array_equal(saved[name], table[name])
+        runs, episodes_run = np.unique(table["run"], return_counts=True)
+        np.testing.assert_array_equal(runs, np.arange(6))
+        assert all(n == 100 or (n >= 50 and n % 25 == 0) for n in episodes_run)
+        for run, n in zip(runs, episodes_run):
+            np.testing.assert_array_equal(table["episode"][table["run"] == run], np.arange(n))
+        assert (table["episode_length"] > 0).all()
+        assert sum(row["episodes_run"] for row in summary) == len(table["run"])
+        assert sum(row["stopped_early"] for row in summary) > 0
+
+    table, summary = sweep("sarsa", {"alpha": [0.1, 0.25, 0.5], "epsilon": [0.05, 0.1, 0.2],
+                                     "discount_factor": [0.9, 1.0]}, num_seeds=5, num_episodes=300)
+    # table, summary = sweep("q_learning", {"epsilon": [0.0, 0.1], "epsilon_decay": [1.0, 0.99]},
+    #                        num_seeds=3, num_episodes=100)
@@ -0,0 +1,173 @@
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+"""
+Low overhead metrics for training loops (sarsa, q_learning, ...).
+Recording an episode only writes one row into a preallocated ring buffer. Everything else
+(counters, histograms, writing to disk, progress output) happens in batches at a flush,
+which runs when flush_interval seconds have passed or when the unflushed rows would
+otherwise be overwritten. Nothing needs a display; the file is CSV or JSON lines.
+"""
+
+
+class Histogram():
+    """
+    Counts of values in fixed bins. counts[0] counts the values below edges[0],
+    counts[i] the values in [edges[i-1], edges[i]) and counts[-1] the values >= edges[-1].
+    """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+
+    def add(self, values):
+        bins = np.searchsorted(self.edges, values, side="right")
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def as_dict(self):
+        return {"edges": self.edges.tolist(), "counts": self.counts.tolist()}
+
+
+def _signed_log_edges(max_power):
+    # -2^k .. -1, 0, 1 .. 2^k: rewards can have either sign
+    positive = 2.0 ** np.arange(max_power + 1)
+    return np.concatenate([-positive[::-1], [0.0], positive])
+
+
+class TrainingTelemetry():
+    """
+    Per-episode training metrics: counters (episodes, steps, total reward), histograms of
+    episode length, episode reward and steps per second, an in-memory ring buffer of the
+    most recent episodes and batched writes to a file. Use as a context manager or call
+    close() when done.
+
+    Args:
+        path: (Optional) file the episodes are appended to. None keeps them in memory only.
+        file_format: "csv" or "jsonl". By default ".jsonl"/".json" paths are JSON lines, others CSV.
+        capacity: Number of episodes kept in the ring buffer.
+        flush_interval: Seconds between flushes.
+        print_progress: Print a progress line at every flush.
+        total_episodes: (Optional) number of episodes of the run, for the progress line.
+        length_edges, reward_edges, speed_edges: (Optional) histogram bin edges.
+    """
+
+    dtype = np.dtype([("episode", np.int64), ("length", np.int64), ("reward", np.float64),
+                      ("steps_per_s", np.float64), ("time", np.float64)])
+
+    def __init__(self, path=None, file_format=None, capacity=4096, flush_interval=10.0, print_progress=False,
+                 total_episodes=None, length_edges=None, reward_edges=None, speed_edges=None):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.print_progress = print_progress
+        self.total_episodes = total_episodes
+
+        self.counters = {"episodes": 0, "steps": 0, "reward": 0.0}
+        self.histograms = {
+            "length": Histogram(2.0 ** np.arange(21) if length_edges is None else length_edges),
+            "reward": Histogram(_signed_log_edges(20) if reward_edges is None else reward_edges),
+            "steps_per_s": Histogram(10.0 ** np.arange(9) if speed_edges is None else speed_edges),
+        }
+
+        self._ring = np.zeros(capacity, dtype=self.dtype)
+        self._n = 0
+        self._n_flushed = 0
+        self._start = self._last = self._last_flush = time.perf_counter()
+
+        self._file = self._writer = None
+        if path is not None:
+            if file_format is None:
+                file_format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+            if file_format not in ("csv", "jsonl"):
+                raise ValueError("file_format must be 'csv' or 'jsonl'")
+            self._file = open(path, "w", newline="")
+            if file_format == "csv":
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(self.dtype.names)
+
+    def record(self, episode, length, reward, wall_time=None):
+        """
+        Records a finished episode.
+
+        Args:
+            episode: Episode number.
+            length: Number of steps of the episode.
+            reward: Total reward of the episode.
+            wall_time: (Optional) seconds the episode took, for its steps per second. By
+                default the time since the previous call, which is only right when the
+                episodes run one after another (not for lockstep copies that finish together).
+        """
+        now = time.perf_counter()
+        if wall_time is None:
+            wall_time = now - self._last
+        self._ring[self._n % self.capacity] = (episode, length, reward, length / max(wall_time, 1e-9),
+                                               now - self._start)
+        self._n += 1
+        self._last = now
+        if now - self._last_flush >= self.flush_interval or self._n - self._n_flushed == self.capacity:
+            self.flush()
+
+    def _rows(self, start, stop):
+        return self._ring[np.arange(start, stop) % self.capacity]
+
+    def recent(self, n=None):
+        """
+        The last n (default: all kept) episodes, oldest first, as a structured array.
+        """
+        n = min(self._n, self.capacity) if n is None else min(n, self._n, self.capacity)
+        return self._rows(self._n - n, self._n)
+
+    def flush(self):
+        """
+        Adds the episodes recorded since the last flush to the counters and histograms and
+        writes them to the file.
+        """
+        rows = self._rows(self._n_flushed, self._n)
+        self._n_flushed = self._n
+        self._last_flush = time.perf_counter()
+        if len(rows) == 0:
+            return
+
+        self.counters["episodes"] += len(rows)
+        self.counters["steps"] += int(rows["length"].sum())
+        self.counters["reward"] += float(rows["reward"].sum())
+        for name, histogram in self.histograms.items():
+            histogram.add(rows[name])
+
+        if self._writer is not None:
+            self._writer.writerows(rows.tolist())
+            self._file.flush()
+        elif self._file is not None:
+            self._file.write("".join(json.dumps(dict(zip(self.dtype.names, row))) + "\n" for row in rows.tolist()))
+            self._file.flush()
+
+        if self.print_progress:
+            elapsed = self._last_flush - self._start
+            total = "/{}".format(self.total_episodes) if self.total_episodes else ""
+            print("\rEpisode {}{}: {:.0f} steps/s, mean reward {:.2f} over the last {} episodes.".format(
+                self.counters["episodes"], total, self.counters["steps"] / max(elapsed, 1e-9),
+                rows["reward"].mean(), len(rows)), end="")
+            sys.stdout.flush()
+
+    def snapshot(self):
+        """
+        Counters and histograms of all episodes so far (flushes first), as plain dictionaries.
+        """
+        self.flush()
+        return {"counters": dict(self.counters, elapsed=self._last_flush - self._start),
+                "histograms": {name: histogram.as_dict() for name, histogram in self.histograms.items()}}
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
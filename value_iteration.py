@@ -1,44 +1,52 @@
+import heapq
 import numpy as np
+import time
 import pprint
 import sys
 if "../" not in sys.path:
   sys.path.append("../")
 from gym.envs.denny.gridworld import GridworldEnv
+from mdp_model import compile_mdp
 
-def value_iteration(env, theta=0.0001, discount_factor=1.0):
+def value_iteration(env, theta=0.0001, discount_factor=1.0, callback=None):
     """
     Value Iteration Algorithm.
 
     Args:
         env: OpenAI environment. env.P represents the transition probabilities of the environment.
+            A MemmapMDP (see mdp_model.save_mdp) is streamed from disk in chunks instead.
         theta: Stopping threshold. If the value of all states changes less than theta
             in one iteration we are done.
         discount_factor: lambda time discount factor.
+        callback: (Optional) called after every sweep, see dp_instrumentation.
 
     Returns:
         A tuple (policy, V) of the optimal policy and the optimal value function.        
     """
 
+    # Compile env.P once; each sweep is then a single sparse mat-vec over all (s, a) pairs
+    mdp = compile_mdp(env)
+
     V = np.zeros(env.nS)
     policy = np.zeros([env.nS, env.nA])  # policy started from zero position
 
+    k = 0
+    start = time.perf_counter()
     while True:
-        delta = 0.0
-
         # Evaluate the value function for 1 iteration using Bellman's optimality eqn
-        for s in range(env.nS):
-            v = np.zeros(env.nA)
+        v = mdp.q_values(V, discount_factor)
 
-            for a, a_prob in enumerate(policy[s]):
-                for prob, next_state, reward, done in env.P[s][a]:
-                    v[a] = prob * (reward + discount_factor * V[next_state])
+        # Update V and improve policy immediately
+        v_max = v.max(axis=1)
+        change = np.abs(v_max - V)
+        delta = np.max(change)
+        V = v_max
+        policy = np.eye(env.nA)[v.argmax(axis=1)]
+        k += 1
 
-            # At the state level: Update V and improve policy immediately
-            v_max = v[v.argmax()]
-            delta = max(delta, abs(v_max-V[s]))
-            V[s] = v_max
-            policy[s] = np.zeros(env.nA)
-            policy[s][v.argmax()] = 1.0
+        if callback is not None:
+            callback(k, delta, np.linalg.norm(change), np.count_nonzero(change > theta),
+                     time.perf_counter() - start)
 
         if delta < theta:
             break
@@ -48,27 +56,89 @@ def value_iteration(env, theta=0.0001, discount_factor=1.0):
 
 
 
-pp = pprint.PrettyPrinter(indent=2)
-env = GridworldEnv()
+def value_iteration_prioritized(env, theta=0.0001, discount_factor=1.0):
+    """
+    Value Iteration with prioritized sweeping. Instead of sweeping every state on every
+    pass we only back up states whose Bellman residual exceeds theta, largest residual first.
+    After a backup only the predecessors of the updated state can have a new residual.
+
+    Args:
+        env: OpenAI environment. env.P represents the transition probabilities of the environment.
+        theta: Stopping threshold. We are done once no state has a Bellman residual above theta.
+        discount_factor: lambda time discount factor.
+
+    Returns:
+        A tuple (policy, V) of the optimal policy and the optimal value function.
+    """
+    mdp = compile_mdp(env)
+    nA = env.nA
+    data, indices, indptr = mdp.P.data, mdp.P.indices, mdp.P.indptr
+    pred = mdp.predecessors()
+    # action taken by every stored transition, so a single state's backup is one bincount
+    entry_action = np.repeat(np.tile(np.arange(nA), env.nS), np.diff(indptr))
+
+    def backup(s):
+        # max_a Q(s, a) for a single state, straight from the CSR rows s*nA .. s*nA + nA - 1
+        lo, hi = indptr[s * nA], indptr[(s + 1) * nA]
+        q = mdp.R[s * nA:(s + 1) * nA] + discount_factor * np.bincount(
+            entry_action[lo:hi], weights=data[lo:hi] * V[indices[lo:hi]], minlength=nA)
+        return q.max()
+
+    V = np.zeros(env.nS)
+
+    # Seed the queue with the residuals of a full (synchronous) backup
+    residual = np.abs(mdp.q_values(V, discount_factor).max(axis=1) - V)
+    priority = np.where(residual > theta, residual, 0.0)
+    # heapq is a min heap, so push negative residuals. Entries whose priority no longer
+    # matches priority[s] are stale and skipped when popped.
+    queue = [(-p, s) for s, p in enumerate(priority) if p > 0]
+    heapq.heapify(queue)
+
+    while queue:
+        p, s = heapq.heappop(queue)
+        if -p != priority[s]:
+            continue
+        priority[s] = 0.0
+        V[s] = backup(s)
+
+        # V[s] changed, so re-check every state that can transition into s
+        for s_pred in pred.indices[pred.indptr[s]:pred.indptr[s + 1]]:
+            r = abs(backup(s_pred) - V[s_pred])
+            if r > theta and r > priority[s_pred]:
+                priority[s_pred] = r
+                heapq.heappush(queue, (-r, s_pred))
+
+    policy = np.eye(env.nA)[mdp.q_values(V, discount_factor).argmax(axis=1)]
+    return policy, V
+
+
+# The demo and checks only run as a script, not when the solvers are imported.
+if __name__ == "__main__":
+    pp = pprint.PrettyPrinter(indent=2)
+    env = GridworldEnv()
+
+    policy, v = value_iteration(env)
 
-policy, v = value_iteration(env)
+    print("Policy Probability Distribution:")
+    print(policy)
+    print("")
 
-print("Policy Probability Distribution:")
-print(policy)
-print("")
+    print("Reshaped Grid Policy (0=up, 1=right, 2=down, 3=left):")
+    print(np.reshape(np.argmax(policy, axis=1), env.shape))
+    print("")
 
-print("Reshaped Grid Policy (0=up, 1=right, 2=down, 3=left):")
-print(np.reshape(np.argmax(policy, axis=1), env.shape))
-print("")
+    print("Value Function:")
+    print(v)
+    print("")
 
-print("Value Function:")
-print(v)
-print("")
+    print("Reshaped Grid Value Function:")
+    print(v.reshape(env.shape))
+    print("")
 
-print("Reshaped Grid Value Function:")
-print(v.reshape(env.shape))
-print("")
+    # Test the value function
+    expected_v = np.array([ 0, -1, -2, -3, -1, -2, -3, -2, -2, -3, -2, -1, -3, -2, -1,  0])
+    np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
 
-# Test the value function
-expected_v = np.array([ 0, -1, -2, -3, -1, -2, -3, -2, -2, -3, -2, -1, -3, -2, -1,  0])
-np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
\ No newline at end of file
+    # Test prioritized sweeping converges to the same value function
+    policy, v = value_iteration_prioritized(env)
+    np.testing.assert_array_almost_equal(v, expected_v, decimal=2)
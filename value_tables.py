@@ -0,0 +1,162 @@
+import numpy as np
+
+from collections.abc import Mapping
+
+"""
+Dense array backed tables for tabular value functions.
+Observations are encoded into flat integer indices so accumulators can be plain numpy
+arrays updated with np.add.at, instead of dicts keyed by observation tuples.
+A Mapping view keeps the dict style interface (e.g. for plotting.plot_value_function).
+"""
+
+# Blackjack observation: (player score 0..31, dealer showing card 0..10, usable ace 0/1)
+BLACKJACK_SHAPE = (32, 11, 2)
+BLACKJACK_SIZE = int(np.prod(BLACKJACK_SHAPE))
+
+
+def encode_blackjack(observations):
+    """
+    Maps Blackjack observations to flat indices into a BLACKJACK_SHAPE table.
+
+    Args:
+        observations: A single (score, dealer_score, usable_ace) tuple, or a sequence /
+            [N, 3] array of them.
+
+    Returns:
+        An int (single observation) or an int64 array of flat indices.
+    """
+    obs = np.asarray(observations, dtype=np.int64)
+    return np.ravel_multi_index((obs[..., 0], obs[..., 1], obs[..., 2]), BLACKJACK_SHAPE)
+
+
+def decode_blackjack(index):
+    """
+    Inverse of encode_blackjack for a single flat index.
+
+    Returns:
+        The (score, dealer_score, usable_ace) observation tuple.
+    """
+    score, dealer_score, usable_ace = np.unravel_index(index, BLACKJACK_SHAPE)
+    return int(score), int(dealer_score), bool(usable_ace)
+
+
+class BlackjackValueView(Mapping):
+    """
+    Read only dict view of a dense Blackjack value table.
+    Iterates over the visited states (count > 0) as (score, dealer_score, usable_ace)
+    tuples. Like the defaultdict it replaces, looking up an unvisited state gives 0.0.
+    """
+
+    def __init__(self, values, counts):
+        self.values = np.asarray(values).reshape(-1)
+        self.counts = np.asarray(counts).reshape(-1)
+
+    def __getitem__(self, observation):
+        try:
+            return float(self.values[encode_blackjack(observation)])
+        except (ValueError, IndexError):
+            raise KeyError(observation)
+
+    def __contains__(self, observation):
+        try:
+            return bool(self.counts[encode_blackjack(observation)] > 0)
+        except (ValueError, IndexError):
+            return False
+
+    def __iter__(self):
+        return (decode_blackjack(i) for i in np.flatnonzero(self.counts))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+
+class ReturnStats():
+    """
+    Per-state running mean and variance of returns on dense tables (Welford's algorithm).
+    Samples are added a chunk at a time: the count, mean and sum of squared deviations of
+    the chunk are computed per state with np.bincount and merged into the running values
+    (Chan et al.'s pairwise update), which is as stable as adding them one by one.
+
+    Args:
+        size: Number of states of the table, e.g. BLACKJACK_SIZE.
+    """
+
+    def __init__(self, size):
+        self.count = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def update(self, states, returns):
+        """
+        Adds the samples returns[i] of states[i] (flat indices).
+        """
+        size = len(self.count)
+        n_b = np.bincount(states, minlength=size).astype(np.float64)
+        seen = n_b > 0
+        mean_b = np.divide(np.bincount(states, returns, minlength=size), n_b, out=np.zeros(size), where=seen)
+        m2_b = np.bincount(states, (returns - mean_b[states]) ** 2, minlength=size)
+
+        n = self.count + n_b
+        delta = mean_b - self.mean
+        self.mean[seen] += delta[seen] * n_b[seen] / n[seen]
+        self.m2[seen] += m2_b[seen] + delta[seen] ** 2 * self.count[seen] * n_b[seen] / n[seen]
+        self.count = n
+
+    def variance(self):
+        """
+        Sample variance of the returns of every state, nan for states with less than 2 samples.
+        """
+        return np.divide(self.m2, self.count - 1, out=np.full(len(self.count), np.nan), where=self.count > 1)
+
+    def half_width(self, z=1.96):
+        """
+        Half-width z * sqrt(variance / count) of the confidence interval of the mean of every
+        state (normal approximation), inf for states with less than 2 samples.
+        """
+        half_width = np.full(len(self.count), np.inf)
+        sampled = self.count > 1
+        half_width[sampled] = z * np.sqrt(self.variance()[sampled] / self.count[sampled])
+        return half_width
+
+
+def make_q_table(env, dtype=np.float64):
+    """
+    Dense [nS, nA] action-value table for an env with discrete observations (env.nS, or
+    observation_space.n), indexed as Q[state, action] and updated in place.
+
+    Returns:
+        The zero initialized table.
+    """
+    nS = getattr(env, "nS", None) or env.observation_space.n
+    nA = getattr(env, "nA", None) or env.action_space.n
+    return np.zeros([nS, nA], dtype=dtype)
+
+
+class QTableView(Mapping):
+    """
+    Dict view state -> action values of a dense [nS, nA] Q table, for callers that expect
+    the defaultdict Q of the tabular algorithms. Q[state] is the row of the table (a numpy
+    view, so Q[state][action] += ... still updates the table). Iterates over all states.
+    The table itself is Q.table, e.g. to snapshot it with Q.table.copy().
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, state):
+        try:
+            return self.table[state]
+        except IndexError:
+            raise KeyError(state)
+
+    def __contains__(self, state):
+        return isinstance(state, (int, np.integer)) and 0 <= state < len(self.table)
+
+    def __iter__(self):
+        return iter(range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return "QTableView({!r})".format(self.table)
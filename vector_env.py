@@ -0,0 +1,86 @@
+import numpy as np
+
+"""
+Lockstep copies of a discrete environment. env.P is flattened once into transition arrays
+(the layout of mdp_model.MemmapMDP) and then N copies are stepped with array operations:
+the next state of every copy is drawn with one np.searchsorted over the cumulative
+transition probabilities, instead of N env.step() calls.
+"""
+
+
+class TabularVectorEnv():
+    """
+    N copies of a discrete env (nS, nA, P and optionally the initial state distribution isd,
+    like gym's DiscreteEnv) stepped together. Copies whose episode ended are reset
+    automatically.
+
+    Args:
+        env: The environment to copy.
+        num_envs: Number of copies N.
+        seed: Seed or np.random.Generator for the transitions and resets.
+    """
+
+    def __init__(self, env, num_envs, seed=None):
+        self.nS, self.nA = env.nS, env.nA
+        self.num_envs = num_envs
+        self.rng = np.random.default_rng(seed)
+
+        counts, transitions = [], []
+        for s in range(self.nS):
+            for a in range(self.nA):
+                counts.append(len(env.P[s][a]))
+                transitions.extend(env.P[s][a])
+        t = np.array(transitions, dtype=float).reshape(-1, 4)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)])
+        self.next_state = t[:, 1].astype(np.int64)
+        self.reward = t[:, 2]
+        self.done = t[:, 3].astype(bool)
+        # a transition is picked by where u * (total probability of its row) falls in the
+        # cumulative probabilities, offset by the probability mass of the rows before
+        self._cumprob = np.cumsum(t[:, 0])
+        self._row_start = np.concatenate([[0.0], self._cumprob])[self.indptr[:-1]]
+        self._row_total = np.add.reduceat(t[:, 0], self.indptr[:-1]) if len(t) else np.zeros(0)
+
+        isd = getattr(env, "isd", None)
+        if isd is None:
+            isd = np.zeros(self.nS)
+            isd[env.reset()] = 1.0
+        self._isd_cumprob = np.cumsum(isd)
+        self.states = np.zeros(num_envs, dtype=np.int64)
+
+    def _initial_states(self, n):
+        u = self.rng.random(n) * self._isd_cumprob[-1]
+        return np.minimum(np.searchsorted(self._isd_cumprob, u, side="right"), self.nS - 1)
+
+    def reset(self):
+        """
+        Resets all copies.
+
+        Returns:
+            The N initial states.
+        """
+        self.states = self._initial_states(self.num_envs)
+        return self.states.copy()
+
+    def step(self, actions):
+        """
+        Takes one step in every copy.
+
+        Args:
+            actions: N actions.
+
+        Returns:
+            A tuple (next_states, rewards, dones, observations). next_states are the states the
+            actions led to (terminal ones included), observations the states the copies are in
+            now: next_states, except for the copies that were done and have been reset.
+        """
+        sa = self.states * self.nA + actions
+        u = self.rng.random(self.num_envs)
+        j = np.searchsorted(self._cumprob, self._row_start[sa] + u * self._row_total[sa], side="right")
+        j = np.clip(j, self.indptr[sa], self.indptr[sa + 1] - 1)
+
+        next_states, rewards, dones = self.next_state[j], self.reward[j], self.done[j]
+        self.states = next_states.copy()
+        if dones.any():
+            self.states[dones] = self._initial_states(np.count_nonzero(dones))
+        return next_states, rewards, dones, self.states.copy()